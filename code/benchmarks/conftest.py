@@ -0,0 +1,125 @@
+"""
+Benchmarks of the perception and map functions (pytest-benchmark). Headless, no simulator needed.
+
+Run from the code folder:
+    python -m pytest benchmarks
+Timings are compared with the baseline saved in benchmarks/timing (timings depend on the machine,
+save a new one with the first command when comparing on another box):
+    python -m pytest benchmarks --benchmark-storage=benchmarks/timing --benchmark-save=baseline
+    python -m pytest benchmarks --benchmark-storage=benchmarks/timing --benchmark-compare \
+        --benchmark-compare-fail=median:25%
+Allocations (tracemalloc, one call) are always checked against benchmarks/allocation_baseline.json,
+a benchmark without a baseline fails. Write it (after a change that is meant to allocate more) with:
+    python -m pytest benchmarks --save-allocation-baseline
+"""
+import json
+import os
+import sys
+import tracemalloc
+import cv2
+import numpy as np
+import pytest
+
+CODE_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, CODE_FOLDER)
+
+from rover_state import RoverState  # noqa: E402
+from supporting_functions import load_ground_truth  # noqa: E402
+
+CALIBRATION_FOLDER = os.path.join(CODE_FOLDER, '..', 'calibration_images')
+CALIBRATION_IMAGES = ['example_grid1.jpg', 'example_grid2.jpg', 'example_rock1.jpg', 'example_rock2.jpg']
+ALLOCATION_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'allocation_baseline.json')
+# allowed growth of the allocated bytes over the baseline
+ALLOCATION_TOLERANCE = 0.2
+
+
+def pytest_addoption(parser):
+    parser.addoption('--save-allocation-baseline', action='store_true',
+                     help='Write the measured allocations to benchmarks/allocation_baseline.json')
+
+
+def read_rgb(name):
+    return cv2.cvtColor(cv2.imread(os.path.join(CALIBRATION_FOLDER, name)), cv2.COLOR_BGR2RGB)
+
+
+def synthetic_frame(seed=0):
+    """
+    A camera sized frame with a bright ground, dark walls and a yellow rock
+    :return:
+    """
+    random = np.random.RandomState(seed)
+    frame = random.randint(0, 100, (160, 320, 3)).astype(np.uint8)
+    frame[90:, 60:260] = random.randint(170, 255, (70, 200, 3))
+    frame[120:130, 150:160] = (140, 130, 20)
+    return frame
+
+
+@pytest.fixture(scope='session', params=CALIBRATION_IMAGES + ['synthetic'])
+def frame(request):
+    if request.param == 'synthetic':
+        return synthetic_frame()
+    return read_rgb(request.param)
+
+
+@pytest.fixture(scope='session')
+def ground_truth():
+    return load_ground_truth()
+
+
+@pytest.fixture
+def rover(ground_truth):
+    Rover = RoverState(world_size=ground_truth.shape[0])
+    Rover.ground_truth = ground_truth
+    Rover.samples_pos = (np.int_([100, 50, 120]), np.int_([90, 60, 150]))
+    Rover.pos = [99.7, 85.6]
+    Rover.yaw, Rover.pitch, Rover.roll = 56.8, 0.3, 359.8
+    Rover.vel, Rover.total_time, Rover.picking_up = 0.0, 1.0, 0
+    return Rover
+
+
+@pytest.fixture(scope='session')
+def allocation_baseline(request):
+    saving = request.config.getoption('--save-allocation-baseline')
+    baseline = {}
+    if os.path.exists(ALLOCATION_BASELINE):
+        with open(ALLOCATION_BASELINE) as baseline_file:
+            baseline = json.load(baseline_file)
+    measured = {}
+    yield baseline, measured, saving
+    if saving:
+        baseline.update(measured)
+        with open(ALLOCATION_BASELINE, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+
+
+@pytest.fixture
+def allocations(request, benchmark, allocation_baseline):
+    """
+    allocations(function, *args) measures the allocations of one call, reports them with the benchmark
+    and fails if they grew more than ALLOCATION_TOLERANCE over the stored baseline
+    """
+    baseline, measured, saving = allocation_baseline
+
+    def measure(function, *args):
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            function(*args)
+            after = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+        benchmark.extra_info['allocated_blocks'] = blocks
+        benchmark.extra_info['peak_bytes'] = peak
+        measured[request.node.name] = peak
+        if not saving:
+            if request.node.name not in baseline:
+                pytest.fail('no allocation baseline for {0}, write it with --save-allocation-baseline'.format(
+                    request.node.name))
+            limit = baseline[request.node.name] * (1 + ALLOCATION_TOLERANCE)
+            assert peak <= limit, 'peak allocation {0} bytes over baseline {1}'.format(
+                peak, baseline[request.node.name])
+        return peak
+
+    return measure
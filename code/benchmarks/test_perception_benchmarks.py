@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+from perception import (perspective_transform, calibration_points, color_threshold, obstacles_threshold,
+                        rocks_threshold, rover_coords, to_polar_coords, pix_to_world, perception_step,
+                        PerceptionContext)
+from supporting_functions import create_output_images
+
+
+@pytest.fixture(scope='module')
+def context():
+    return PerceptionContext()
+
+
+@pytest.fixture
+def warped(frame, context):
+    return context.warp(frame)
+
+
+@pytest.fixture
+def terrain(warped):
+    return color_threshold(warped, rgb_thresh=(160, 160, 160))
+
+
+def test_perspective_transform(benchmark, allocations, frame):
+    source, destination = calibration_points(frame.shape)
+    allocations(perspective_transform, frame, source, destination)
+    benchmark(perspective_transform, frame, source, destination)
+
+
+def test_context_warp(benchmark, allocations, frame, context):
+    allocations(context.warp, frame)
+    benchmark(context.warp, frame)
+
+
+def test_color_threshold(benchmark, allocations, warped):
+    allocations(color_threshold, warped, (160, 160, 160))
+    benchmark(color_threshold, warped, (160, 160, 160))
+
+
+def test_obstacles_threshold(benchmark, allocations, warped):
+    allocations(obstacles_threshold, warped, (160, 160, 100), (0, 0, 0))
+    benchmark(obstacles_threshold, warped, (160, 160, 100), (0, 0, 0))
+
+
+def test_rocks_threshold(benchmark, allocations, warped):
+    allocations(rocks_threshold, warped)
+    benchmark(rocks_threshold, warped)
+
+
+def test_fused_classifier(benchmark, allocations, warped, context):
+    def classify():
+        return context.classifier.views(context.classifier.classify(warped))
+
+    allocations(classify)
+    benchmark(classify)
+
+
+def test_rover_coords(benchmark, allocations, terrain):
+    allocations(rover_coords, terrain)
+    benchmark(rover_coords, terrain)
+
+
+def test_to_polar_coords(benchmark, allocations, terrain):
+    x_pixel, y_pixel = rover_coords(terrain)
+    allocations(to_polar_coords, x_pixel, y_pixel)
+    benchmark(to_polar_coords, x_pixel, y_pixel)
+
+
+def test_rover_polar_tables(benchmark, allocations, terrain, context):
+    allocations(context.rover_polar, terrain)
+    benchmark(context.rover_polar, terrain)
+
+
+def test_pix_to_world(benchmark, allocations, terrain):
+    x_pixel, y_pixel = rover_coords(terrain)
+    allocations(pix_to_world, x_pixel, y_pixel, 99.7, 85.6, 56.8, 200, 10)
+    benchmark(pix_to_world, x_pixel, y_pixel, 99.7, 85.6, 56.8, 200, 10)
+
+
+def test_perception_step(benchmark, allocations, frame, rover, context):
+    rover.img = frame
+    allocations(perception_step, rover, context)
+    benchmark(perception_step, rover, context)
+
+
+def test_create_output_images(benchmark, allocations, frame, rover, context):
+    rover.img = frame
+    # a few frames from different poses so the map is not empty
+    for step in range(10):
+        rover.pos = [99.7 + step, 85.6 + 0.5 * step]
+        rover.yaw = (56.8 + 36 * step) % 360
+        perception_step(rover, context)
+    assert np.count_nonzero(rover.map_view()) > 0
+    allocations(create_output_images, rover)
+    benchmark(create_output_images, rover)
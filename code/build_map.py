@@ -0,0 +1,162 @@
+# Builds the worldmap of a run recorded with drive_rover.py --record (or into an image folder) on all cores.
+# Every worker process maps chunks of frames with perception_batch into its own map held in shared memory,
+# the parent adds the maps up at the end and renders the create_output_images report.
+# Example: $ python build_map.py run.jsonl --workers 8 --output map.jpg
+import argparse
+import base64
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+import numpy as np
+from rover_state import RoverState
+from perception import perception_batch, PerceptionContext
+from supporting_functions import TelemetryParser, FrameDecoder, create_output_images, load_ground_truth
+from recording import FrameRecording, open_recording
+
+# worker process state, set up by _init_worker
+_worker = None
+
+
+class _MapWorker:
+    """
+    What a worker process keeps between chunks: its private shared memory map and the decoding/perception state
+    """
+
+    def __init__(self, shared_map_name, shape, recording, resolution):
+        self.shared_map = shared_memory.SharedMemory(name=shared_map_name)
+        self.worldmap = np.ndarray(shape, dtype=np.uint32, buffer=self.shared_map.buf)
+        # TelemetryRecording or FrameRecording, whatever open_recording returned
+        self.recording = recording
+        self.resolution = resolution  # type: int
+        self.context = PerceptionContext()
+        self.parser = TelemetryParser()
+        self.decoder = FrameDecoder()
+
+    def map_chunk(self, start, stop):
+        """
+        Map messages [start, stop) of the recording into this worker's map
+        :return: number of frames mapped
+        """
+        frames, poses = [], []
+        for data in self.recording.read(start, stop):
+            if isinstance(data, dict):
+                record = self.parser.parse(data)
+                frame = None
+            else:
+                # frame recordings hold parsed telemetry and views of the decoded images
+                record, frame = data
+            # same as telemetry in drive_rover.py: invalid telemetry is skipped
+            if not np.isfinite(record.vel):
+                continue
+            if frame is None:
+                frame, _ = self.decoder.decode(data["image"])
+            frames.append(frame.copy())
+            poses.append((record.pos[0], record.pos[1], record.yaw, record.pitch, record.roll))
+        if len(frames) == 0:
+            return 0
+        xpos, ypos, yaw, pitch, roll = np.array(poses).T
+        return perception_batch(np.stack(frames), xpos, ypos, yaw, pitch, roll, self.worldmap,
+                                self.context, self.resolution)
+
+
+def _init_worker(shared_map_names, shape, recording, resolution):
+    global _worker
+    _worker = _MapWorker(shared_map_names.get(), shape, recording, resolution)
+
+
+def _map_chunk(chunk):
+    return _worker.map_chunk(*chunk)
+
+
+def build_map(recording, world_size=200, resolution=1, workers=None, chunk_size=256):
+    """
+    Map a whole recording on a process pool
+    :param recording: TelemetryRecording or FrameRecording
+    :param world_size: world side in meters
+    :param resolution: map cells per meter
+    :param workers: number of processes (all cores if None)
+    :param chunk_size: frames per task
+    :return: (world_size * resolution, world_size * resolution, 3) uint64 hit counts, frames mapped
+    """
+    workers = workers or multiprocessing.cpu_count()
+    shape = (world_size * resolution, world_size * resolution, 3)
+    map_bytes = int(np.prod(shape)) * np.dtype(np.uint32).itemsize
+    shared_maps = [shared_memory.SharedMemory(create=True, size=map_bytes) for _ in range(workers)]
+    try:
+        names = multiprocessing.Queue()
+        for shared_map in shared_maps:
+            np.ndarray(shape, dtype=np.uint32, buffer=shared_map.buf)[:] = 0
+            names.put(shared_map.name)
+        chunks = [(start, min(start + chunk_size, len(recording))) for start in range(0, len(recording), chunk_size)]
+        pool = multiprocessing.Pool(workers, _init_worker, (names, shape, recording, resolution))
+        try:
+            mapped = sum(pool.imap_unordered(_map_chunk, chunks))
+        finally:
+            pool.close()
+            pool.join()
+        # reduction of the private maps
+        worldmap = np.zeros(shape, dtype=np.uint64)
+        for shared_map in shared_maps:
+            worldmap += np.ndarray(shape, dtype=np.uint32, buffer=shared_map.buf)
+        return worldmap, mapped
+    finally:
+        for shared_map in shared_maps:
+            shared_map.close()
+            shared_map.unlink()
+
+
+def report(worldmap, resolution, ground_truth, samples_pos, output):
+    """
+    Render the create_output_images map of a built worldmap
+    :param worldmap: hit counts from build_map
+    :param resolution: map cells per meter
+    :param ground_truth: 3 channel ground truth map
+    :param samples_pos: sample positions of the run
+    :param output: JPEG file for the map image
+    :return: the RoverState holding the map
+    """
+    Rover = RoverState(world_size=ground_truth.shape[0], map_resolution=resolution)
+    Rover.ground_truth = ground_truth
+    Rover.samples_pos = samples_pos
+    Rover.total_time = 0
+    Rover.worldmap[:] = np.minimum(worldmap, np.iinfo(Rover.worldmap.dtype).max)
+    Rover.map_stats.set_ground_truth(ground_truth[:, :, 1] > 0)
+    Rover.map_stats.rebuild(Rover.map_view())
+    # every rock cell of the map is a detection, weighted by its hits
+    rock_map = Rover.map_view()[:, :, 1]
+    for row, col in zip(*np.nonzero(rock_map)):
+        Rover.rocks.add((col, row), hits=int(rock_map[row, col]))
+    map_image, _ = create_output_images(Rover)
+    with open(output, 'wb') as map_file:
+        map_file.write(base64.b64decode(map_image))
+    return Rover
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the worldmap of a recorded run on all cores')
+    parser.add_argument('recording', type=str,
+                        help='Telemetry file written by drive_rover.py --record, or a frame recording folder')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: all cores).')
+    parser.add_argument('--chunk_size', type=int, default=256, help='Frames per task.')
+    parser.add_argument('--map_resolution', type=int, default=1, help='Worldmap cells per meter.')
+    parser.add_argument('--output', type=str, default='map.jpg', help='Where to save the map image.')
+    args = parser.parse_args()
+
+    recorded_run = open_recording(args.recording)
+    ground_truth_3d = load_ground_truth()
+    started = time.time()
+    built_map, frames_mapped = build_map(recorded_run, ground_truth_3d.shape[0], args.map_resolution,
+                                         args.workers, args.chunk_size)
+    elapsed = time.time() - started
+    if isinstance(recorded_run, FrameRecording):
+        samples_pos = recorded_run.samples_pos
+    else:
+        samples_pos = TelemetryParser().parse(recorded_run[0], samples=True).samples_pos
+    Rover = report(built_map, args.map_resolution, ground_truth_3d, samples_pos, args.output)
+    stats = Rover.map_stats
+    print('Mapped {0} of {1} frames in {2:.2f} s ({3:.1f} frames/s)'.format(
+        frames_mapped, len(recorded_run), elapsed, len(recorded_run) / elapsed))
+    print('Mapped: {0:.1f}%  Fidelity: {1:.1f}%  Map saved to {2}'.format(
+        100.0 * stats.good_nav_pix / max(stats.tot_map_pix, 1),
+        100.0 * stats.good_nav_pix / max(stats.cells[2], 1), os.path.abspath(args.output)))
@@ -0,0 +1,158 @@
+import time
+from collections import deque
+from profiling import profiler
+
+# command priorities: a preempting command goes in front of every queued command of lower priority
+NORMAL = 0
+HIGH = 1
+URGENT = 2
+
+
+class Command:
+    """
+    A command of the rover state machine. The name is the mode the rover is in while executing it
+    """
+    __slots__ = ()
+    name = 'command'
+    priority = NORMAL
+
+    def arguments(self):
+        return ()
+
+    def __str__(self):
+        return ' '.join([self.name] + ['{0:g}'.format(argument) for argument in self.arguments()])
+
+    __repr__ = __str__
+
+
+class Mapping(Command):
+    """Crawl along the left wall"""
+    __slots__ = ()
+    name = 'mapping'
+
+
+class GoYaw(Command):
+    """Turn in place to a yaw (degrees)"""
+    __slots__ = ('yaw',)
+    name = 'go-yaw'
+
+    def __init__(self, yaw):
+        self.yaw = yaw  # type: float
+
+    def arguments(self):
+        return self.yaw,
+
+
+class GoForward(Command):
+    """Drive straight for some meters"""
+    __slots__ = ('meters',)
+    name = 'go-forward'
+
+    def __init__(self, meters):
+        self.meters = meters  # type: float
+
+    def arguments(self):
+        return self.meters,
+
+
+class Collecting(Command):
+    """Drive to the rock in sight and pick it up"""
+    __slots__ = ()
+    name = 'collecting'
+    priority = HIGH
+
+
+class Unstuck(Command):
+    """Try random moves until the rover moves again"""
+    __slots__ = ()
+    name = 'unstuck'
+    priority = URGENT
+
+
+def profile_command(command, seconds):
+    """
+    Dispatch hook that records the time of every command type in the profiler (when it is enabled)
+    """
+    if profiler.enabled:
+        profiler.record('command ' + command.name, seconds)
+
+
+class CommandQueue:
+    """
+    The pending commands of the rover, the one executing first.
+    dispatch() runs the current command through a table of handlers by command type, and reports the time
+    it took to the hooks. Preempting commands are inserted by priority, planned routes as one batch.
+    """
+
+    def __init__(self, commands=(), hooks=(profile_command,)):
+        self.queue = deque(commands)
+        # functions(command, seconds) called after every dispatch
+        self.hooks = list(hooks)  # type: list
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __iter__(self):
+        return iter(self.queue)
+
+    def __getitem__(self, index):
+        return self.queue[index]
+
+    def __str__(self):
+        return str([str(command) for command in self.queue])
+
+    @property
+    def current(self):
+        """The command on top, None if there is none"""
+        return self.queue[0] if self.queue else None
+
+    def push(self, command):
+        """Add a command after the others"""
+        self.queue.append(command)
+
+    def push_front(self, commands):
+        """Put a batch of commands, e.g. a planned route, in front of the others, in order"""
+        self.queue.extendleft(reversed(commands))
+
+    def replace(self, commands):
+        """Drop the pending commands for a new batch"""
+        self.queue.clear()
+        self.queue.extend(commands)
+
+    def preempt(self, command):
+        """
+        Insert a command in front of every command of lower priority
+        :param command: Command
+        :return: True if it is the current command now
+        """
+        position = 0
+        for queued in self.queue:
+            if queued.priority < command.priority:
+                break
+            position += 1
+        self.queue.insert(position, command)
+        return position == 0
+
+    def pop(self):
+        """Remove the current command, it finished"""
+        return self.queue.popleft()
+
+    def contains(self, command_type):
+        return any(isinstance(command, command_type) for command in self.queue)
+
+    def dispatch(self, handlers, rover):
+        """
+        Execute one cycle of the current command
+        :param handlers: {Command type: function(rover, command)}
+        :param rover: RoverState
+        :return:
+        """
+        command = self.queue[0]
+        if not self.hooks:
+            handlers[type(command)](rover, command)
+            return
+        start = time.perf_counter()
+        handlers[type(command)](rover, command)
+        seconds = time.perf_counter() - start
+        for hook in self.hooks:
+            hook(command, seconds)
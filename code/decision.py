@@ -3,7 +3,10 @@ from rover_state import RoverState
 import logging
 
 logger = logging.getLogger('main_app.decisions')
-logger.setLevel(logging.DEBUG)
+# sampled navigation diagnostics (structured, see log_handlers.JsonLinesHandler)
+nav_logger = logging.getLogger('main_app.nav')
+# log the navigation diagnostics every this many frames
+NAV_LOG_INTERVAL = 10
 
 
 # TODO:  - add documentation to every function
@@ -27,10 +30,11 @@ def decision_step(Rover):
 
     Rover.update_state()
 
-    logger.debug("Current Mode: {0}".format(Rover.mode))
-    logger.debug("Current Commands: {0!s}".format(Rover.commands))
+    logger.debug('Current Mode: %s', Rover.mode)
+    logger.debug('Current Commands: %s', Rover.commands)
 
-    Rover.print_nav_info()
+    if Rover.frames % NAV_LOG_INTERVAL == 0 and nav_logger.isEnabledFor(logging.INFO):
+        nav_logger.info('mode %s, trapped %s', Rover.mode, Rover.trapped(), extra={'data': Rover.nav_info()})
     Rover.next_cycle()
 
     return Rover
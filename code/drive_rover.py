@@ -10,14 +10,14 @@ import socketio
 import eventlet
 import eventlet.wsgi
 from PIL import Image
-from flask import Flask
+from flask import Flask, jsonify
 from io import BytesIO, StringIO
 import json
 import pickle
-import matplotlib.image as mpimg
 import time
 from rover_state import RoverState
 import logging
+from log_handlers import start_queue_logging, JsonLinesHandler
 
 DEBUG_ON = False
 
@@ -40,27 +40,27 @@ ch.setLevel(logging.INFO)  # ERROR should be in the normal app.
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 fh.setFormatter(formatter)
 ch.setFormatter(formatter)
-# add the handlers to the logger
-logger.addHandler(fh)
-logger.addHandler(ch)
+# add the handlers to the logger. The control loop only enqueues the records, a listener thread writes them
+log_listener = start_queue_logging(logger, [fh, ch])
 
 # Import functions for perception and decision making
 from perception import perception_step
 from decision import decision_step
-from supporting_functions import update_rover, create_output_images
+from supporting_functions import update_rover, create_output_images, load_ground_truth, blank_inset_images
+from recording import TelemetryRecorder, FrameRecorder
+from profiling import profiler
+from renderer import AsyncRenderer
+from pipeline import FramePipeline
+from scheduler import FrameScheduler, FramePlan
+from planner import Planner
+from frontiers import FrontierSearch
 # Initialize socketio server and Flask application 
 # (learn more at: https://python-socketio.readthedocs.io/en/latest/)
 sio = socketio.Server()
 app = Flask(__name__)
 
 # Read in ground truth map and create 3-channel green version for over plotting
-# NOTE: images are read in by default with the origin (0, 0) in the upper left
-# and y-axis increasing downward.
-ground_truth = mpimg.imread('../calibration_images/map_bw.png')
-# This next line creates arrays of zeros in the red and blue channels
-# and puts the map into the green channel.  This is why the underlying 
-# map output looks green in the display image
-ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.float)
+ground_truth_3d = load_ground_truth()
 
 # Initialize our rover 
 Rover = RoverState()
@@ -73,6 +73,21 @@ frame_counter = 0
 second_counter = time.time()
 fps = None
 
+# Renders the inset images in the background when --render_rate is set. None renders on every frame
+renderer = None
+# Records the telemetry for replay.py when --record is set
+recorder = None
+# Records the camera frames into the image folder (unless --jpeg_frames)
+frame_recorder = None
+# Parses, decodes and thresholds the next frame while this one is decided, when --pipelined is set
+pipeline = None
+# Skips the map update and rendering of some frames when frames arrive faster than they are processed (--adaptive)
+scheduler = None
+# what the frames run without a scheduler
+FULL_FRAME = FramePlan()
+# the last rendered inset images, sent again on frames that skip rendering (black ones until the first render)
+inset_images = blank_inset_images()
+
 
 # Define telemetry function for what to do with incoming data
 @sio.on('telemetry')
@@ -85,25 +100,56 @@ def telemetry(sid, data):
         fps = frame_counter
         frame_counter = 0
         second_counter = time.time()
-    print("Current FPS: {}".format(fps))
+        profiler.counters['fps'] = fps
+        logger.info('Current FPS: %s', fps)
 
     if data:
-        global Rover
-        # Initialize / update Rover with current telemetry
-        Rover, image = update_rover(Rover, data)
+        global Rover, inset_images
+        plan = FULL_FRAME if scheduler is None else scheduler.begin()
+        if plan.drop:
+            # too far behind even for the cheap path: send the last commands again and take the next message
+            send_control((Rover.throttle, Rover.brake, Rover.steer), *inset_images)
+            scheduler.end(plan)
+            return
+        if recorder is not None:
+            recorder.record(data)
+        if pipeline is None:
+            # Initialize / update Rover with current telemetry
+            Rover, image = update_rover(Rover, data)
+        else:
+            # the frame that finished the front stage while the previous one was decided (one frame behind)
+            features = pipeline.exchange(data)
+            if features is None:
+                # nothing finished yet: keep the last commands
+                send_control((Rover.throttle, Rover.brake, Rover.steer), *inset_images)
+                if scheduler is not None:
+                    scheduler.end(plan)
+                return
+            # telemetry and perception of that frame are applied here, on this thread
+            Rover, image = pipeline.apply(Rover, features, plan.update_map)
 
         if np.isfinite(Rover.vel):
 
             # Execute the perception and decision steps to update the Rover's state
-            Rover = perception_step(Rover)
-            Rover = decision_step(Rover)
+            if pipeline is None:
+                Rover = perception_step(Rover, update_map=plan.update_map)
+            with profiler.stage('decision_step'):
+                Rover = decision_step(Rover)
 
-            # Create output images to send to server
-            out_image_string1, out_image_string2 = create_output_images(Rover)
+            # Create output images to send to server (the previous ones when the scheduler skips rendering)
+            if renderer is None:
+                if plan.render:
+                    inset_images = create_output_images(Rover)
+            else:
+                if plan.render:
+                    renderer.submit(Rover)
+                inset_images = renderer.latest()
+            out_image_string1, out_image_string2 = inset_images
 
             # The action step!  Send commands to the rover!
             commands = (Rover.throttle, Rover.brake, Rover.steer)
-            send_control(commands, out_image_string1, out_image_string2)
+            with profiler.stage('send_control'):
+                send_control(commands, out_image_string1, out_image_string2)
  
             # If in a state where want to pickup a rock send pickup command
             if Rover.send_pickup:
@@ -113,25 +159,36 @@ def telemetry(sid, data):
         # In case of invalid telemetry, send null commands
         else:
 
-            # Send zeros for throttle, brake and steer and empty images
-            send_control((0, 0, 0), '', '')
+            # Send zeros for throttle, brake and steer and the last images
+            send_control((0, 0, 0), *inset_images)
 
         # If you want to save camera images from autonomous driving specify a path
         # Example: $ python drive_rover.py image_folder_path
         # Conditional to save image frame if folder was specified
-        if args.image_folder != '':
+        if frame_recorder is not None:
+            frame_recorder.record(Rover)
+        elif args.image_folder != '':
             timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
             image_filename = os.path.join(args.image_folder, timestamp)
             image.save('{}.jpg'.format(image_filename))
 
+        profiler.maybe_dump()
+        if scheduler is not None:
+            scheduler.end(plan)
     else:
         sio.emit('manual', data={}, skip_sid=True)
 
 
+@app.route('/stats')
+def stats():
+    # latency histograms of the frame stages (enabled with --profile)
+    return jsonify(profiler.summary())
+
+
 @sio.on('connect')
 def connect(sid, environ):
-    print("connect ", sid)
-    send_control((0, 0, 0), '', '')
+    logger.info('connect %s', sid)
+    send_control((0, 0, 0), *inset_images)
     sample_data = {}
     sio.emit(
         "get_samples",
@@ -157,7 +214,7 @@ def send_control(commands, image_string1, image_string2):
 
 # Define a function to send the "pickup" command 
 def send_pickup():
-    print("Picking up")
+    logger.info('Picking up')
     pickup = {}
     sio.emit(
         "pickup",
@@ -171,10 +228,99 @@ if __name__ == '__main__':
         type=str,
         nargs='?',
         default='',
-        help='Path to image folder. This is where the images from the run will be saved.'
+        help='Path to image folder. This is where the frames of the run will be saved '
+             '(see replay.py and build_map.py).'
+    )
+    parser.add_argument(
+        '--map_resolution',
+        type=int,
+        default=1,
+        help='Worldmap cells per meter.'
+    )
+    parser.add_argument(
+        '--tiled_map',
+        action='store_true',
+        help='Allocate the worldmap in tiles only where the rover has seen something.'
+    )
+    parser.add_argument(
+        '--render_rate',
+        type=float,
+        default=0,
+        help='Render the inset images in the background this many times per second. 0 renders every frame.'
+    )
+    parser.add_argument(
+        '--record',
+        type=str,
+        default='',
+        help='Save every telemetry message (frames included) to this file, for replay.py.'
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Time every stage of the frame pipeline. Histograms are served at http://localhost:4567/stats'
+    )
+    parser.add_argument(
+        '--profile_dump',
+        type=str,
+        default=None,
+        help='With --profile, also write the histograms to this JSON file every few seconds.'
+    )
+    parser.add_argument(
+        '--pipelined',
+        action='store_true',
+        help='Decode and threshold the next frame on a worker thread while the current one is decided.'
+    )
+    parser.add_argument(
+        '--adaptive',
+        action='store_true',
+        help='Skip the map update and rendering on some frames (drop frames if need be) '
+             'when the rover falls behind the simulator.'
+    )
+    parser.add_argument(
+        '--return_time',
+        type=float,
+        default=None,
+        help='Drive back to the starting point after this many seconds, even if samples are missing.'
+    )
+    parser.add_argument(
+        '--no_planner',
+        action='store_true',
+        help='Do not plan routes (no return to the starting point, no frontier exploration).'
+    )
+    parser.add_argument(
+        '--jpeg_frames',
+        action='store_true',
+        help='Save the frames of the image folder as one JPEG file each instead of memory mapped chunks.'
+    )
+    parser.add_argument(
+        '--log_jsonl',
+        type=str,
+        default=None,
+        help='Also write the log records, with the sampled navigation diagnostics, to this JSON lines file.'
     )
     args = parser.parse_args()
-    
+
+    Rover = RoverState(world_size=ground_truth_3d.shape[0], map_resolution=args.map_resolution,
+                       tiled_map=args.tiled_map)
+    Rover.ground_truth = ground_truth_3d
+    if args.log_jsonl is not None:
+        log_listener.handlers += (JsonLinesHandler(args.log_jsonl),)
+    if not args.no_planner:
+        Rover.planner = Planner()
+        Rover.frontiers = FrontierSearch()
+        Rover.return_time = args.return_time
+    if args.render_rate > 0:
+        renderer = AsyncRenderer(create_output_images, args.render_rate, inset_images)
+    if args.profile:
+        profiler.enable(args.profile_dump)
+    if args.pipelined:
+        pipeline = FramePipeline()
+    if args.adaptive:
+        scheduler = FrameScheduler()
+    if args.record != '':
+        print("Recording telemetry to {}".format(args.record))
+        recorder = TelemetryRecorder(args.record)
+
     os.system('rm -rf IMG_stream/*')
     if args.image_folder != '':
         print("Creating image folder at {}".format(args.image_folder))
@@ -183,6 +329,8 @@ if __name__ == '__main__':
         else:
             shutil.rmtree(args.image_folder)
             os.makedirs(args.image_folder)
+        if not args.jpeg_frames:
+            frame_recorder = FrameRecorder(args.image_folder)
         print("Recording this run ...")
     else:
         print("NOT recording this run ...")
@@ -191,4 +339,13 @@ if __name__ == '__main__':
     app = socketio.Middleware(sio, app)
 
     # deploy as an eventlet WSGI server
-    eventlet.wsgi.server(eventlet.listen(('', 4567)), app)
+    try:
+        eventlet.wsgi.server(eventlet.listen(('', 4567)), app)
+    finally:
+        if recorder is not None:
+            recorder.close()
+        if frame_recorder is not None:
+            frame_recorder.close()
+        log_listener.stop()
+        for handler in log_listener.handlers:
+            handler.close()
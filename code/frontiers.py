@@ -0,0 +1,114 @@
+import cv2
+import numpy as np
+
+# navigation map codes, see RoverState.generate_exploration_map
+UNKNOWN = -1
+
+# the 4 neighbours of a cell
+CROSS = np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]], dtype=np.uint8)
+
+
+def frontier_cells(navigation_map):
+    """
+    Known passable cells (terrain or visited) next to an unknown cell
+    :param navigation_map: navigation map codes
+    :return: boolean array
+    """
+    unknown = (navigation_map == UNKNOWN).view(np.uint8)
+    next_to_unknown = cv2.dilate(unknown, CROSS, borderType=cv2.BORDER_CONSTANT, borderValue=0).view(np.bool_)
+    return next_to_unknown & (navigation_map >= 0)
+
+
+class Frontier:
+    """
+    A connected group of frontier cells
+    """
+    __slots__ = ('size', 'centroid', 'target', 'distance', 'score')
+
+    def __init__(self, size, centroid, target, distance, score):
+        self.size = size  # type: int
+        # (x, y) in meters
+        self.centroid = centroid  # type: tuple
+        # the cell of the group closest to the rover, (x, y) in meters
+        self.target = target  # type: tuple
+        # straight line distance of the target to the rover
+        self.distance = distance  # type: float
+        self.score = score  # type: float
+
+
+class FrontierSearch:
+    """
+    Keeps the frontier of the navigation map. update() only reclassifies the cells around those that changed,
+    clusters() groups the frontier with connected components and scores the groups by size over distance.
+    """
+
+    def __init__(self, min_size=3, min_distance=3.0):
+        """
+        :param min_size: smaller groups are ignored (noise at the edge of the map)
+        :param min_distance: groups closer to the rover than this (meters) are ignored, it is exploring them already
+        """
+        self.min_size = min_size  # type: int
+        self.min_distance = min_distance  # type: float
+        self.navigation_map = None  # type: np.ndarray
+        self.frontier = None  # type: np.ndarray
+
+    def update(self, navigation_map, changed=None):
+        """
+        Bring the frontier up to date
+        :param navigation_map: navigation map codes
+        :param changed: flat indices of the cells whose code changed since the last update
+                        (RoverState.planning_changes), the whole map is compared if None
+        :return: number of changed cells
+        """
+        if self.frontier is None or self.frontier.shape != navigation_map.shape:
+            self.navigation_map = navigation_map.copy()
+            self.frontier = frontier_cells(navigation_map)
+            return navigation_map.size
+        if changed is None:
+            changed = np.flatnonzero(navigation_map != self.navigation_map)
+        if len(changed) == 0:
+            return 0
+        rows, cols = np.divmod(changed, navigation_map.shape[1])
+        self.navigation_map[rows, cols] = navigation_map[rows, cols]
+        # a cell's frontier status depends on its 4 neighbours: recompute the box around the changes
+        # (with one more cell of margin for the neighbours of the border cells)
+        height, width = navigation_map.shape
+        top, bottom = max(rows.min() - 1, 0), min(rows.max() + 2, height)
+        left, right = max(cols.min() - 1, 0), min(cols.max() + 2, width)
+        outer_top, outer_bottom = max(top - 1, 0), min(bottom + 1, height)
+        outer_left, outer_right = max(left - 1, 0), min(right + 1, width)
+        box = frontier_cells(self.navigation_map[outer_top:outer_bottom, outer_left:outer_right])
+        self.frontier[top:bottom, left:right] = box[top - outer_top:bottom - outer_top,
+                                                    left - outer_left:right - outer_left]
+        return len(rows)
+
+    def clusters(self, position):
+        """
+        The frontier groups, best first
+        :param position: (x, y) of the rover in meters
+        :return: list of Frontier
+        """
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats(self.frontier.view(np.uint8),
+                                                                           connectivity=8)
+        large = [label for label in range(1, count) if stats[label, cv2.CC_STAT_AREA] >= self.min_size]
+        if len(large) == 0:
+            return []
+        rows, cols = np.nonzero(np.isin(labels, large))
+        cell_labels = labels[rows, cols]
+        # cell centers in meters and their distance to the rover
+        xs, ys = cols + 0.5, rows + 0.5
+        distances = np.hypot(xs - position[0], ys - position[1])
+        # the closest cell of every group
+        order = np.lexsort((distances, cell_labels))
+        first = order[np.r_[True, cell_labels[order][1:] != cell_labels[order][:-1]]]
+
+        frontiers = []
+        for index in first:
+            label, distance = cell_labels[index], distances[index]
+            if distance < self.min_distance:
+                continue
+            size = int(stats[label, cv2.CC_STAT_AREA])
+            frontiers.append(Frontier(size, tuple(centroids[label]), (xs[index], ys[index]), float(distance),
+                                      float(size / (1.0 + distance))))
+        frontiers.sort(key=lambda frontier: -frontier.score)
+        return frontiers
@@ -0,0 +1,50 @@
+import json
+import logging
+import logging.handlers
+import queue
+
+
+class JsonLinesHandler(logging.Handler):
+    """
+    Writes every record as one JSON line: time, logger, level, message and the structured
+    fields passed with extra={'data': {...}}, e.g. the navigation diagnostics of decision_step
+    """
+
+    def __init__(self, path):
+        logging.Handler.__init__(self)
+        self.file = open(path, 'w')
+
+    def emit(self, record):
+        try:
+            line = {'time': record.created, 'logger': record.name, 'level': record.levelname,
+                    'message': record.getMessage()}
+            data = getattr(record, 'data', None)
+            if data is not None:
+                line.update(data)
+            self.file.write(json.dumps(line, default=float))
+            self.file.write('\n')
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+        logging.Handler.close(self)
+
+
+def start_queue_logging(logger, handlers):
+    """
+    Route the records of a logger through a queue: the logging call only enqueues the record,
+    the handlers (files, console) run on the thread of a QueueListener
+    :param logger: the logger the application logs to (its children propagate to it)
+    :param handlers: the handlers that do the writing
+    :return: the started QueueListener, stop it on exit to flush the queue
+    """
+    records = queue.Queue()
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    # handler levels are honoured by the listener
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -2,6 +2,8 @@ import numpy as np
 import cv2
 from rover_state import RoverState
 from utilities import distance
+from world_map import accumulate, hits_per_frame
+from profiling import profiler
 
 
 # Identify pixels above the threshold
@@ -60,14 +62,73 @@ def rocks_threshold(img, threshold_low=(100, 100, 0), threshold_high=(160, 160,
     return color_select
 
 
+# Label bits of the fused classifier. A pixel can carry more than one (rocks are also dark enough to be obstacles)
+UNKNOWN = 0
+TERRAIN = 1
+OBSTACLE = 2
+ROCK = 4
+
+
+class ColorClassifier:
+    """
+    Single pass replacement of color_threshold, obstacles_threshold and rocks_threshold.
+    Every threshold is a per channel comparison, so each channel value is mapped through a packed lookup table
+    holding the terrain/obstacle/rock bits it satisfies and the three channels are AND-ed into one label image.
+    """
+
+    def __init__(self, terrain_thresh=(160, 160, 160),
+                 obstacles_high=(160, 160, 100), obstacles_low=(0, 0, 0),
+                 rocks_low=(100, 100, 0), rocks_high=(160, 160, 40),
+                 region=(slice(80, None), slice(80, 240))):
+        values = np.arange(256)
+        lut = np.zeros((1, 256, 3), dtype=np.uint8)
+        for c in range(3):
+            lut[0, :, c] = (TERRAIN * (values > terrain_thresh[c]) +
+                            OBSTACLE * ((values < obstacles_high[c]) & (obstacles_low[c] < values)) +
+                            ROCK * ((values > rocks_low[c]) & (values < rocks_high[c])))
+        self.lut = lut  # type: np.ndarray
+        # terrain and obstacles are only trusted in this part of the warped image. rocks everywhere
+        self.region = region  # type: tuple
+        self.region_mask = None  # type: np.ndarray
+
+    def classify(self, img):
+        """
+        Label every pixel of a (warped) RGB image, or of a stack of them
+        :param img: uint8 RGB image (rows, cols, 3) or stack (frames, rows, cols, 3)
+        :return: uint8 image(s) of TERRAIN | OBSTACLE | ROCK bits (UNKNOWN when none apply)
+        """
+        image_shape = img.shape[-3:-1]
+        if self.region_mask is None or self.region_mask.shape != image_shape:
+            self.region_mask = np.full(image_shape, ROCK, dtype=np.uint8)
+            self.region_mask[self.region] = TERRAIN | OBSTACLE | ROCK
+        # cv2.LUT takes one image, a stack is looked up as one tall image
+        channel_bits = cv2.LUT(img.reshape((-1,) + img.shape[-2:]), self.lut).reshape(img.shape)
+        labels = np.bitwise_and(channel_bits[..., 0], channel_bits[..., 1])
+        np.bitwise_and(labels, channel_bits[..., 2], out=labels)
+        np.bitwise_and(labels, self.region_mask, out=labels)
+        return labels
+
+    @staticmethod
+    def views(labels):
+        """
+        The binary images the three threshold functions used to return
+        :param labels: output of classify
+        :return: terrain, obstacles, rocks as 0/1 uint8 images
+        """
+        terrain = labels & TERRAIN
+        obstacles = (labels >> 1) & 1
+        rocks = labels >> 2
+        return terrain, obstacles, rocks
+
+
 # Define a function to convert to rover-centric coordinates
 def rover_coords(binary_img):
     # Identify nonzero pixels
     ypos, xpos = binary_img.nonzero()
     # Calculate pixel positions with reference to the rover position being at the 
     # center bottom of the image.  
-    x_pixel = np.absolute(ypos - binary_img.shape[0]).astype(np.float)
-    y_pixel = -(xpos - binary_img.shape[0]).astype(np.float)
+    x_pixel = np.absolute(ypos - binary_img.shape[0]).astype(np.float64)
+    y_pixel = -(xpos - binary_img.shape[0]).astype(np.float64)
     return x_pixel, y_pixel
 
 
@@ -125,6 +186,111 @@ def perspective_transform(img, src, dst):
     return warped
 
 
+def calibration_points(image_shape, dst_size=5, bottom_offset=6):
+    """
+    Source and destination points of the camera calibration for an image of the given shape
+    :param image_shape: (rows, cols, ...) of the camera image
+    :param dst_size: half the side of a 1 square meter grid cell on the warped image
+    :param bottom_offset: distance of the rover from the bottom of the image
+    :return: source, destination as float32 arrays
+    """
+    rows, cols = image_shape[0], image_shape[1]
+    source = np.float32([[14, 140], [301, 140], [200, 96], [118, 96]])
+    destination = np.float32([[cols / 2 - dst_size, rows - bottom_offset],
+                              [cols / 2 + dst_size, rows - bottom_offset],
+                              [cols / 2 + dst_size, rows - 2 * dst_size - bottom_offset],
+                              [cols / 2 - dst_size, rows - 2 * dst_size - bottom_offset],
+                              ])
+    return source, destination
+
+
+class PerceptionContext:
+    """
+    Holds everything in the perception pipeline that depends only on the camera geometry.
+    The homography and the remap tables are computed once per image size and reused by every frame,
+    so a frame only pays for the warp itself.
+    """
+
+    def __init__(self, dst_size=5, bottom_offset=6):
+        self.dst_size = dst_size  # type: int
+        self.bottom_offset = bottom_offset  # type: int
+        # terrain/obstacle/rock pixel classifier
+        self.classifier = ColorClassifier()  # type: ColorClassifier
+        # scale between rover pixels and world meters
+        self.scale = dst_size * 2  # type: int
+        # the image shape the cached tables were built for
+        self.image_shape = None  # type: tuple
+        # the perspective transform matrix
+        self.matrix = None  # type: np.ndarray
+        # source coordinates of every warped pixel (cv2.remap tables)
+        self.map_x = None  # type: np.ndarray
+        self.map_y = None  # type: np.ndarray
+        # rover centric coordinates and polar coordinates of every pixel (flattened)
+        self.x_table = None  # type: np.ndarray
+        self.y_table = None  # type: np.ndarray
+        self.dist_table = None  # type: np.ndarray
+        self.angle_table = None  # type: np.ndarray
+
+    @property
+    def hits_per_frame(self):
+        """
+        The hits a frame adds to a display cell it sees at this scale, for NavigationMap and RoverState
+        :return: 
+        """
+        return hits_per_frame(self.scale)
+
+    def prepare(self, image_shape):
+        """
+        Build the cached tables if the image size changed (or on first use)
+        :param image_shape: shape of the camera image
+        :return: 
+        """
+        image_shape = tuple(image_shape[:2])
+        if image_shape == self.image_shape:
+            return
+        rows, cols = image_shape
+        source, destination = calibration_points(image_shape, self.dst_size, self.bottom_offset)
+        self.matrix = cv2.getPerspectiveTransform(source, destination)
+        # warpPerspective samples the source at inverse(M) * destination, so precompute exactly that
+        inverse = np.linalg.inv(self.matrix)
+        grid_x, grid_y = np.meshgrid(np.arange(cols, dtype=np.float64), np.arange(rows, dtype=np.float64))
+        weight = inverse[2, 0] * grid_x + inverse[2, 1] * grid_y + inverse[2, 2]
+        # pixels on the horizon map to infinity, which remap treats as outside the image
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.map_x = ((inverse[0, 0] * grid_x + inverse[0, 1] * grid_y + inverse[0, 2]) / weight).astype(np.float32)
+            self.map_y = ((inverse[1, 0] * grid_x + inverse[1, 1] * grid_y + inverse[1, 2]) / weight).astype(np.float32)
+        # same convention as rover_coords/to_polar_coords, precomputed for the whole pixel grid
+        rows_grid, cols_grid = np.indices(image_shape)
+        self.x_table = np.absolute(rows_grid - rows).astype(np.float64).ravel()
+        self.y_table = -(cols_grid - rows).astype(np.float64).ravel()
+        self.dist_table, self.angle_table = to_polar_coords(self.x_table, self.y_table)
+        self.image_shape = image_shape
+
+    def rover_polar(self, binary_img):
+        """
+        rover_coords and to_polar_coords of a binary image, read from the precomputed tables
+        :param binary_img: mask of the same size as the camera image
+        :return: x_pixel, y_pixel, distances, angles
+        """
+        self.prepare(binary_img.shape)
+        indices = np.flatnonzero(binary_img)
+        return (self.x_table[indices], self.y_table[indices],
+                self.dist_table[indices], self.angle_table[indices])
+
+    def warp(self, img):
+        """
+        The birds view of the camera image. Same result as perspective_transform with the calibration points
+        :param img: camera image
+        :return: warped image, same size as the input
+        """
+        self.prepare(img.shape)
+        return cv2.remap(img, self.map_x, self.map_y, cv2.INTER_LINEAR)
+
+
+# the context used by perception_step when the caller does not provide one
+default_context = PerceptionContext()
+
+
 def locate_rock(points_x, points_y):
     if points_x.size > 0 and points_y.size > 0:
         return np.int_(np.mean(points_x)), np.int_(np.mean(points_y))
@@ -132,72 +298,185 @@ def locate_rock(points_x, points_y):
         return None, None
 
 
-# Apply the above functions in succession and update the Rover state accordingly
-# noinspection PyPep8Naming
-def perception_step(Rover):
-    # type: (RoverState) -> RoverState
-    # Perform perception steps to update Rover()
-    # NOTE: camera image is coming to you in Rover.img
-    # 1) Define source and destination points for perspective transform
-    dst_size = 5
-    bottom_offset = 6
-    source = np.float32([[14, 140], [301, 140], [200, 96], [118, 96]])
-    destination = np.float32([[Rover.img.shape[1] / 2 - dst_size, Rover.img.shape[0] - bottom_offset],
-                              [Rover.img.shape[1] / 2 + dst_size, Rover.img.shape[0] - bottom_offset],
-                              [Rover.img.shape[1] / 2 + dst_size, Rover.img.shape[0] - 2 * dst_size - bottom_offset],
-                              [Rover.img.shape[1] / 2 - dst_size, Rover.img.shape[0] - 2 * dst_size - bottom_offset],
-                              ])
+def perception_batch(frames, xpos, ypos, yaw, pitch, roll, worldmap, context=None, resolution=1, stats=None):
+    """
+    Map a stack of camera frames in one go, e.g. a recorded IMG folder.
+    Same results as running perception_step frame by frame (steps 2 - 7), without a RoverState.
+    The projection to world coordinates and the map update run vectorized over the whole stack;
+    the warp and the classifier (already array operations) run per frame while the image is in cache.
+    Memory is a few times the labelled pixels of the stack, so feed long runs in chunks.
+    :param frames: (N, rows, cols, 3) uint8 camera frames
+    :param xpos: (N,) rover x in meters
+    :param ypos: (N,) rover y in meters
+    :param yaw: (N,) degrees
+    :param pitch: (N,) degrees, frames that are not level are not mapped (same as perception_step)
+    :param roll: (N,) degrees
+    :param worldmap: worldmap to accumulate into (dense or TiledWorldMap)
+    :param context: PerceptionContext
+    :param resolution: worldmap cells per meter
+    :param stats: MapStatistics to keep up to date
+    :return: the number of frames that were mapped
+    """
+    context = default_context if context is None else context
+    xpos, ypos, yaw, pitch, roll = [np.asarray(values, dtype=np.float64) for values in (xpos, ypos, yaw, pitch, roll)]
+    # 7) pitch/roll gating: only level frames update the map
+    level = ((roll <= 1.0) | (roll >= 359.0)) & ((pitch <= 1.0) | (pitch >= 359.0))
+    selected = np.flatnonzero(level)
+    if selected.size == 0:
+        return 0
+    frames = frames[selected]
+    xpos, ypos, yaw = xpos[selected] * resolution, ypos[selected] * resolution, yaw[selected]
+
+    # 2, 3) Apply perspective transform and color threshold
+    # frame by frame while the warped image is still in cache, that beats warping the whole stack first
+    context.prepare(frames.shape[1:3])
+    birds_view = np.empty_like(frames[0])
+    labels = np.empty(frames.shape[:1] + (frames.shape[1] * frames.shape[2],), dtype=np.uint8)
+    for index in range(frames.shape[0]):
+        cv2.remap(frames[index], context.map_x, context.map_y, cv2.INTER_LINEAR, dst=birds_view)
+        labels[index] = context.classifier.classify(birds_view).ravel()
+
+    # 5, 6) rover-centric and then world coordinates of every labelled pixel of every frame, in one pass
+    world_size = worldmap.shape[0]
+    scale = context.scale / resolution
+    yaw_rad = yaw * np.pi / 180
+    cos_yaw, sin_yaw = np.cos(yaw_rad), np.sin(yaw_rad)
+    labelled = np.flatnonzero(labels)
+    pixel_labels = labels.ravel()[labelled]
+    frame_index, pixel = np.divmod(labelled, labels.shape[1])
+    x_pixel, y_pixel = context.x_table[pixel], context.y_table[pixel]
+    cos_frame, sin_frame = cos_yaw[frame_index], sin_yaw[frame_index]
+    # same operations as pix_to_world
+    x_world = np.clip(np.int_((x_pixel * cos_frame - y_pixel * sin_frame) / scale + xpos[frame_index]),
+                      0, world_size - 1)
+    y_world = np.clip(np.int_((x_pixel * sin_frame + y_pixel * cos_frame) / scale + ypos[frame_index]),
+                      0, world_size - 1)
+
+    obstacles = (pixel_labels & OBSTACLE) > 0
+    terrain = (pixel_labels & TERRAIN) > 0
+    # locate_rock: one hit at the mean rock position of each frame that sees a rock
+    rocks = (pixel_labels & ROCK) > 0
+    rock_frames = frame_index[rocks]
+    rock_pixels = np.bincount(rock_frames, minlength=frames.shape[0])
+    seeing = rock_pixels > 0
+    rocks_x_world = np.int_(np.bincount(rock_frames, x_world[rocks], frames.shape[0])[seeing] / rock_pixels[seeing])
+    rocks_y_world = np.int_(np.bincount(rock_frames, y_world[rocks], frames.shape[0])[seeing] / rock_pixels[seeing])
+
+    # 7) Update the worldmap, one accumulation per channel for the whole stack
+    accumulate(worldmap, y_world[obstacles], x_world[obstacles], 0, stats)
+    accumulate(worldmap, rocks_y_world, rocks_x_world, 1, stats)
+    accumulate(worldmap, y_world[terrain], x_world[terrain], 2, stats)
+    return selected.size
+
+
+class FramePerception:
+    """
+    What perception gets out of the camera image alone (steps 2, 3 and 5 of perception_step).
+    It does not touch the rover state, so it can be computed on another thread.
+    """
+    __slots__ = ('terrain', 'obstacles', 'rocks', 'terrain_pixels', 'obstacles_pixels', 'rocks_pixels')
+
+    def __init__(self, terrain, obstacles, rocks, terrain_pixels, obstacles_pixels, rocks_pixels):
+        # binary images
+        self.terrain = terrain  # type: np.ndarray
+        self.obstacles = obstacles  # type: np.ndarray
+        self.rocks = rocks  # type: np.ndarray
+        # x_pixel, y_pixel, distances, angles of each binary image
+        self.terrain_pixels = terrain_pixels  # type: tuple
+        self.obstacles_pixels = obstacles_pixels  # type: tuple
+        self.rocks_pixels = rocks_pixels  # type: tuple
+
+
+def perceive(img, context=None):
+    # type: (np.ndarray, PerceptionContext) -> FramePerception
+    # 1) Source and destination points for perspective transform are cached in the context
+    context = default_context if context is None else context
 
     # 2) Apply perspective transform
-    birds_view = perspective_transform(Rover.img, source, destination)
+    with profiler.stage('warp'):
+        birds_view = context.warp(img)
 
-    # 3) Apply color threshold to identify navigable terrain/obstacles/rock samples
-    thresholded_terrain = color_threshold(birds_view, rgb_thresh=(160, 160, 160))
-    thresholded_obstacles = obstacles_threshold(birds_view,
-                                                threshold_high=(160, 160, 100),
-                                                threshold_low=(0, 0, 0))
-    thresholded_rocks = rocks_threshold(birds_view)
+    # 3) Apply color threshold to identify navigable terrain/obstacles/rock samples (one fused pass)
+    with profiler.stage('thresholds'):
+        labels = context.classifier.classify(birds_view)
+        thresholded_terrain, thresholded_obstacles, thresholded_rocks = context.classifier.views(labels)
 
-    # 4) Update Rover.vision_image (this will be displayed on left side of screen)
-    Rover.terrain = thresholded_terrain
-    Rover.vision_image[:, :, 0] = thresholded_obstacles * 255
-    Rover.vision_image[:, :, 1] = thresholded_rocks * 255
-    Rover.vision_image[:, :, 2] = thresholded_terrain * 255
+    # 5) Convert map image pixel values to rover-centric coords (polar coordinates come with them)
+    return FramePerception(thresholded_terrain, thresholded_obstacles, thresholded_rocks,
+                           context.rover_polar(thresholded_terrain),
+                           context.rover_polar(thresholded_obstacles),
+                           context.rover_polar(thresholded_rocks))
 
-    # 5) Convert map image pixel values to rover-centric coords
-    terrain_x_pixel, terrain_y_pixel = rover_coords(thresholded_terrain)
-    obstacles_x_pixel, obstacles_y_pixel = rover_coords(thresholded_obstacles)
-    rocks_x_pixel, rocks_y_pixel = rover_coords(thresholded_rocks)
+
+# noinspection PyPep8Naming
+def apply_perception(Rover, perception, context=None, update_map=True):
+    # type: (RoverState, FramePerception, PerceptionContext, bool) -> RoverState
+    # The steps of perception_step that need the rover state.
+    # update_map=False skips the worldmap (steps 6 and 7 for terrain and obstacles) when the frame is late,
+    # the steering inputs are always updated
+    context = default_context if context is None else context
+    terrain_x_pixel, terrain_y_pixel, terrain_dists, terrain_angles = perception.terrain_pixels
+    obstacles_x_pixel, obstacles_y_pixel, obstacles_dists, obstacles_angles = perception.obstacles_pixels
+    rocks_x_pixel, rocks_y_pixel, rocks_dists, rocks_angles = perception.rocks_pixels
+
+    # 4) Update Rover.vision_image (this will be displayed on left side of screen)
+    Rover.terrain = perception.terrain
+    Rover.vision_image[:, :, 0] = perception.obstacles * 255
+    Rover.vision_image[:, :, 1] = perception.rocks * 255
+    Rover.vision_image[:, :, 2] = perception.terrain * 255
 
     # 6) Convert rover-centric pixel values to world coordinates
-    xpos, ypos, yaw = Rover.pos[0], Rover.pos[1], Rover.yaw
+    # (in worldmap cells, which are 1 / Rover.map_resolution meters wide)
+    resolution = Rover.map_resolution
+    xpos, ypos, yaw = Rover.pos[0] * resolution, Rover.pos[1] * resolution, Rover.yaw
     world_size = Rover.worldmap.shape[0]
-    scale = dst_size * 2
+    scale = context.scale / resolution
 
-    terrain_x_world, terrain_y_world = pix_to_world(terrain_x_pixel, terrain_y_pixel,
-                                                    xpos, ypos, yaw, world_size, scale)
+    with profiler.stage('pix_to_world'):
+        if update_map:
+            terrain_x_world, terrain_y_world = pix_to_world(terrain_x_pixel, terrain_y_pixel,
+                                                            xpos, ypos, yaw, world_size, scale)
+
+            obstacles_x_world, obstacles_y_world = pix_to_world(obstacles_x_pixel, obstacles_y_pixel,
+                                                                xpos, ypos, yaw, world_size, scale)
 
-    obstacles_x_world, obstacles_y_world = pix_to_world(obstacles_x_pixel, obstacles_y_pixel,
-                                                        xpos, ypos, yaw, world_size, scale)
+        # the rock position is needed for collecting, so it is located on every frame
+        rocks_x_world, rocks_y_world = pix_to_world(rocks_x_pixel, rocks_y_pixel,
+                                                    xpos, ypos, yaw, world_size, scale)
 
-    rocks_x_world, rocks_y_world = pix_to_world(rocks_x_pixel, rocks_y_pixel, xpos, ypos, yaw, world_size, scale)
+        rocks_x_world, rocks_y_world = locate_rock(rocks_x_world, rocks_y_world)
 
-    rocks_x_world, rocks_y_world = locate_rock(rocks_x_world, rocks_y_world)
+    # the projection is only trusted when the rover is level
+    level = (Rover.roll <= 1.0 or Rover.roll >= 359.0) and (Rover.pitch <= 1.0 or Rover.pitch >= 359.0)
+    # the rock registry clusters the detections of every level frame, late frames included
+    if level and rocks_x_world is not None:
+        Rover.rocks.add((rocks_x_world / resolution, rocks_y_world / resolution), time=Rover.total_time)
 
     # 7) Update Rover worldmap (to be displayed on right side of screen)
-    if (Rover.roll <= 1.0 or Rover.roll >= 359.0) and (Rover.pitch <= 1.0 or Rover.pitch >= 359.0):
-        Rover.worldmap[obstacles_y_world, obstacles_x_world, 0] += 1
-        Rover.worldmap[rocks_y_world, rocks_x_world, 1] += 1
-        Rover.worldmap[terrain_y_world, terrain_x_world, 2] += 1
+    if update_map and level:
+        with profiler.stage('map_update'):
+            accumulate(Rover.worldmap, obstacles_y_world, obstacles_x_world, 0, Rover.map_listeners)
+            accumulate(Rover.worldmap, rocks_y_world, rocks_x_world, 1, Rover.map_listeners)
+            accumulate(Rover.worldmap, terrain_y_world, terrain_x_world, 2, Rover.map_listeners)
 
-    # 8) Convert rover-centric pixel positions to polar coordinates
+    # 8) Polar coordinates of the rover-centric pixels (looked up in step 5)
     # Update Rover pixel distances and angles
-    Rover.nav_dists, Rover.nav_angles = to_polar_coords(terrain_x_pixel, terrain_y_pixel)
-    # Rover.obs_dists, Rover.obs_angles = to_polar_coords(obstacles_x_pixel, obstacles_y_pixel)
-    Rover.rock_dists, Rover.rock_angles = to_polar_coords(rocks_x_pixel, rocks_y_pixel)
+    Rover.nav_dists, Rover.nav_angles = terrain_dists, terrain_angles
+    Rover.obs_dists, Rover.obs_angles = obstacles_dists, obstacles_angles
+    Rover.rock_dists, Rover.rock_angles = rocks_dists, rocks_angles
     # do not change the value unless you see a rock. it would be reset after collecting
     if not Rover.picking_up and len(Rover.rock_angles) > 0 and np.mean(Rover.rock_dists) <= 100:
-        # pick up only what is in my way.
-        Rover.seen_rock = Rover.seen_rock if rocks_x_world is None else (rocks_x_world, rocks_y_world)
+        # pick up only what is in my way. (seen_rock is in meters like Rover.pos)
+        Rover.seen_rock = Rover.seen_rock if rocks_x_world is None else (rocks_x_world // resolution,
+                                                                         rocks_y_world // resolution)
 
     return Rover
+
+
+# Apply the above functions in succession and update the Rover state accordingly
+# noinspection PyPep8Naming
+def perception_step(Rover, context=None, update_map=True):
+    # type: (RoverState, PerceptionContext, bool) -> RoverState
+    # Perform perception steps to update Rover()
+    # NOTE: camera image is coming to you in Rover.img
+    return apply_perception(Rover, perceive(Rover.img, context), context, update_map)
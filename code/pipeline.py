@@ -0,0 +1,103 @@
+import threading
+import logging
+import numpy as np
+from perception import perceive, apply_perception, PerceptionContext
+from supporting_functions import TelemetryParser, FrameDecoder, apply_telemetry
+from profiling import profiler
+
+logger = logging.getLogger('main_app.pipeline')
+
+
+class FrameFeatures:
+    """
+    Everything the front stage computes from one telemetry message without touching the rover state
+    """
+    __slots__ = ('record', 'img', 'image', 'perception')
+
+    def __init__(self, record, img, image, perception):
+        self.record = record  # TelemetryRecord (sample positions always parsed)
+        self.img = img  # decoded RGB camera frame
+        self.image = image  # EncodedFrame, for saving
+        self.perception = perception  # FramePerception
+
+
+class FramePipeline:
+    """
+    Overlaps the front of the frame pipeline (parse, decode, warp, thresholds) with the decision and control
+    of the previous frame. A worker thread runs the front stage (NumPy/OpenCV release the GIL);
+    the rover state is only ever updated on the caller's thread, by apply().
+
+    There is one input slot and one output slot. A message waiting in the input slot is replaced by a newer one
+    and a result nobody picked up is replaced by a newer one, so under load stale frames are dropped
+    and the frame the decision works on is at most one frame behind.
+    """
+
+    def __init__(self, context=None):
+        self.context = context if context is not None else PerceptionContext()
+        self.parser = TelemetryParser()
+        # three buffers: the frame being applied, the one waiting in the output slot and the one being decoded
+        self.decoder = FrameDecoder(buffers=3)
+        self.condition = threading.Condition()
+        self.waiting = None  # type: dict
+        self.ready = None  # type: FrameFeatures
+        self.dropped = 0  # type: int
+        self.thread = threading.Thread(target=self.run, name='frame-pipeline')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def front(self, data):
+        """
+        The front stage for one telemetry message
+        :param data: telemetry dictionary
+        :return: FrameFeatures
+        """
+        record = self.parser.parse(data, samples=True)
+        with profiler.stage('decode'):
+            img, image = self.decoder.decode(data["image"])
+        return FrameFeatures(record, img, image, perceive(img, self.context))
+
+    def exchange(self, data):
+        """
+        Queue a message for the front stage and take the newest finished frame
+        :param data: telemetry dictionary
+        :return: FrameFeatures, or None if no frame finished since the last call
+        """
+        with self.condition:
+            if self.waiting is not None:
+                self.dropped += 1
+            self.waiting = data
+            ready, self.ready = self.ready, None
+            self.condition.notify()
+        profiler.counters['pipeline_dropped'] = self.dropped
+        return ready
+
+    def apply(self, Rover, features, update_map=True):
+        """
+        Hand a finished frame over to the rover state: telemetry, camera image and perception results.
+        Like in telemetry(), the perception results of invalid telemetry are not used
+        :param Rover: RoverState
+        :param features: FrameFeatures from exchange
+        :param update_map: also add the frame to the worldmap (see apply_perception)
+        :return: Rover, EncodedFrame of the camera image
+        """
+        apply_telemetry(Rover, features.record)
+        Rover.img = features.img
+        if np.isfinite(Rover.vel):
+            apply_perception(Rover, features.perception, self.context, update_map)
+        return Rover, features.image
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.waiting is None:
+                    self.condition.wait()
+                data, self.waiting = self.waiting, None
+            try:
+                features = self.front(data)
+            except Exception:
+                logger.exception('front stage failed')
+                continue
+            with self.condition:
+                if self.ready is not None:
+                    self.dropped += 1
+                self.ready = features
@@ -0,0 +1,273 @@
+import heapq
+import cv2
+import numpy as np
+from math import atan2, degrees, sqrt
+from decision import get_moves
+from commands import GoYaw, GoForward
+
+# move costs of the 8 connected grid (cells are 1 meter wide)
+DIAGONAL = sqrt(2)
+# distances are sums of 1 and DIAGONAL steps, compared with this much slack for the rounding
+TOLERANCE = 1e-9
+
+
+def passable_cells(navigation_map):
+    """
+    Cells the rover can drive through: known terrain and visited cells (see RoverState.generate_exploration_map)
+    :param navigation_map: navigation map codes
+    :return: boolean array
+    """
+    return navigation_map >= 0
+
+
+def neighbours(passable, row, col):
+    """
+    The 8 connected moves out of a cell with their cost. A diagonal move is only allowed when both cells
+    it cuts the corner of are passable, so routes do not squeeze between two obstacles.
+    :param passable: boolean map
+    :param row:
+    :param col:
+    :return: list of (row, col, cost)
+    """
+    rows, cols = passable.shape
+    moves = []
+    for move_row, move_col in get_moves(row, col, rows, cols, all_moves=True):
+        if not passable[move_row, move_col]:
+            continue
+        if move_row != row and move_col != col:
+            if not (passable[move_row, col] and passable[row, move_col]):
+                continue
+            moves.append((move_row, move_col, DIAGONAL))
+        else:
+            moves.append((move_row, move_col, 1.0))
+    return moves
+
+
+def octile(row, col, goal_row, goal_col):
+    """Exact distance on an empty 8 connected grid, the A* heuristic"""
+    d_row, d_col = abs(row - goal_row), abs(col - goal_col)
+    return max(d_row, d_col) + (DIAGONAL - 1) * min(d_row, d_col)
+
+
+def cell_of(point):
+    """(x, y) in meters -> (row, col) of the navigation map"""
+    return int(point[1]), int(point[0])
+
+
+def a_star(passable, start, goal):
+    """
+    Shortest 8 connected route between two cells
+    :param passable: boolean map
+    :param start: (row, col)
+    :param goal: (row, col), may be an unknown cell (e.g. a rock next to a wall)
+    :return: list of (row, col) from start to goal, None if there is no route
+    """
+    passable = passable.copy()
+    passable[start] = passable[goal] = True
+    costs = {start: 0.0}
+    came_from = {start: None}
+    frontier = [(octile(start[0], start[1], goal[0], goal[1]), start)]
+    while frontier:
+        _, cell = heapq.heappop(frontier)
+        if cell == goal:
+            route = []
+            while cell is not None:
+                route.append(cell)
+                cell = came_from[cell]
+            return route[::-1]
+        cost = costs[cell]
+        for row, col, step in neighbours(passable, cell[0], cell[1]):
+            new_cost = cost + step
+            if new_cost < costs.get((row, col), np.inf):
+                costs[(row, col)] = new_cost
+                came_from[(row, col)] = cell
+                heapq.heappush(frontier, (new_cost + octile(row, col, goal[0], goal[1]), (row, col)))
+    return None
+
+
+def line_of_sight(passable, start, end):
+    """
+    Is the straight segment between two cell centers over passable cells only
+    :param passable: boolean map
+    :param start: (row, col)
+    :param end: (row, col)
+    :return:
+    """
+    samples = int(2 * max(abs(end[0] - start[0]), abs(end[1] - start[1]))) + 1
+    rows = np.rint(np.linspace(start[0], end[0], samples + 1)).astype(np.int_)
+    cols = np.rint(np.linspace(start[1], end[1], samples + 1)).astype(np.int_)
+    return bool(np.all(passable[rows, cols]))
+
+
+def simplify(passable, route):
+    """
+    Replace the staircase of a grid route with the fewest straight segments that stay on passable cells
+    :param passable: boolean map
+    :param route: list of (row, col)
+    :return: list of (row, col) waypoints, first and last cell included
+    """
+    if len(route) <= 2:
+        return list(route)
+    waypoints = [route[0]]
+    anchor = 0
+    for index in range(2, len(route)):
+        if not line_of_sight(passable, route[anchor], route[index]):
+            anchor = index - 1
+            waypoints.append(route[anchor])
+    waypoints.append(route[-1])
+    return waypoints
+
+
+def route_commands(waypoints, min_length=0.5):
+    """
+    Turn waypoints into the commands of RoverState: a GoYaw then a GoForward per segment
+    :param waypoints: list of (row, col)
+    :param min_length: shorter segments are dropped
+    :return: list of Command
+    """
+    commands = []
+    for (row, col), (next_row, next_col) in zip(waypoints[:-1], waypoints[1:]):
+        length = sqrt((next_row - row) ** 2 + (next_col - col) ** 2)
+        if length < min_length:
+            continue
+        # map x is the column and y is the row, yaw is measured from x
+        commands.append(GoYaw(round(degrees(atan2(next_row - row, next_col - col)), 1)))
+        commands.append(GoForward(round(length, 1)))
+    return commands
+
+
+class Planner:
+    """
+    Plans over RoverState.navigation_map. Keeps the distance field of the base (the Dijkstra distance of
+    every passable cell to it) and updates it when cells change instead of recomputing it:
+    cells that became passable lower the distances around them (Dijkstra restarts from their neighbours),
+    cells that became blocked invalidate every distance at least as long as theirs, which is then recomputed
+    from the cells below it.
+    """
+
+    def __init__(self):
+        self.base = None  # type: tuple
+        self.passable = None  # type: np.ndarray
+        self.distances = None  # type: np.ndarray
+
+    def update(self, navigation_map, base, changed=None):
+        """
+        Bring the distance field up to date with the navigation map
+        :param navigation_map: navigation map codes
+        :param base: (x, y) of the base in meters
+        :param changed: flat indices of the cells whose code changed since the last update
+                        (RoverState.planning_changes), the whole map is compared if None
+        :return: number of cells whose passability changed
+        """
+        base_cell = cell_of(base)
+        if self.distances is None or base_cell != self.base or navigation_map.shape != self.passable.shape:
+            passable = passable_cells(navigation_map)
+            passable[base_cell] = True
+            self.base = base_cell
+            self.passable = passable
+            self.distances = np.full(passable.shape, np.inf)
+            self.distances[base_cell] = 0.0
+            self.relax([(0.0, base_cell)])
+            return int(np.count_nonzero(passable))
+
+        if changed is None:
+            passable = passable_cells(navigation_map)
+            passable[base_cell] = True
+            changed = np.flatnonzero(passable != self.passable)
+        if len(changed) == 0:
+            return 0
+        flat_passable = self.passable.reshape(-1)
+        flat_distances = self.distances.reshape(-1)
+        now_passable = passable_cells(navigation_map.reshape(-1)[changed])
+        now_passable[changed == np.ravel_multi_index(base_cell, self.passable.shape)] = True
+        was_passable = flat_passable[changed]
+        opened = changed[now_passable & ~was_passable]
+        blocked = changed[was_passable & ~now_passable]
+        flat_passable[opened] = True
+        flat_passable[blocked] = False
+        seeds = []
+        if blocked.size > 0:
+            shortest = flat_distances[blocked].min()
+            if np.isfinite(shortest):
+                # nothing shorter than the closest blocked cell went through a blocked cell
+                self.distances[self.distances >= shortest] = np.inf
+                # the cells one step below the invalidated ones restart Dijkstra
+                # (with slack: 8.41... - 1.41... can round to just above 7.0)
+                rows, cols = np.nonzero((self.distances >= shortest - DIAGONAL - TOLERANCE) &
+                                        np.isfinite(self.distances))
+                seeds.extend((self.distances[row, col], (row, col)) for row, col in zip(rows, cols))
+            flat_distances[blocked] = np.inf
+        if opened.size > 0:
+            # relaxing the neighbours of the opened cells reaches them, and the diagonals they unblocked
+            around = np.zeros(self.passable.shape, dtype=np.uint8)
+            around.reshape(-1)[opened] = 1
+            around = cv2.dilate(around, np.ones((3, 3), np.uint8)).view(np.bool_)
+            rows, cols = np.nonzero(around & np.isfinite(self.distances))
+            seeds.extend((self.distances[row, col], (row, col)) for row, col in zip(rows, cols))
+        heapq.heapify(seeds)
+        self.relax(seeds)
+        return int(opened.size + blocked.size)
+
+    def relax(self, frontier):
+        """
+        Dijkstra from the cells of the frontier over the passable cells
+        :param frontier: heap of (distance, (row, col))
+        :return:
+        """
+        distances, passable = self.distances, self.passable
+        while frontier:
+            distance, (row, col) = heapq.heappop(frontier)
+            if distance > distances[row, col]:
+                continue
+            for next_row, next_col, step in neighbours(passable, row, col):
+                new_distance = distance + step
+                if new_distance < distances[next_row, next_col]:
+                    distances[next_row, next_col] = new_distance
+                    heapq.heappush(frontier, (new_distance, (next_row, next_col)))
+
+    def distance_to_base(self, position):
+        """
+        :param position: (x, y) in meters
+        :return: driving distance to the base in meters (inf if it is not reachable over known terrain)
+        """
+        return self.distances[cell_of(position)]
+
+    def route_to_base(self, position):
+        """
+        Descend the distance field from a position
+        :param position: (x, y) in meters
+        :return: list of (row, col) ending at the base, None if the base is not reachable
+        """
+        cell = cell_of(position)
+        if not np.isfinite(self.distances[cell]):
+            # the rover may stand on a cell not mapped as terrain yet, start from its best neighbour
+            passable = self.passable.copy()
+            passable[cell] = True
+            steps = [(self.distances[row, col] + step, (row, col)) for row, col, step in neighbours(passable, *cell)]
+            if len(steps) == 0 or not np.isfinite(min(steps)[0]):
+                return None
+            route = [cell]
+            cell = min(steps)[1]
+        else:
+            route = []
+        while cell != self.base:
+            route.append(cell)
+            cell = min(neighbours(self.passable, *cell), key=lambda move: self.distances[move[0], move[1]] + move[2])[:2]
+        route.append(cell)
+        return route
+
+    def route(self, position, target):
+        """
+        A* route between two points of the navigation map
+        :param position: (x, y) in meters
+        :param target: (x, y) in meters
+        :return: list of (row, col), None if there is no route over known terrain
+        """
+        return a_star(self.passable, cell_of(position), cell_of(target))
+
+    def commands(self, route):
+        """
+        :param route: list of (row, col) from route or route_to_base
+        :return: GoYaw / GoForward commands that drive it
+        """
+        return route_commands(simplify(self.passable, route))
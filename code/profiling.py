@@ -0,0 +1,148 @@
+import bisect
+import json
+import threading
+import time
+
+# upper edges of the histogram buckets: 1 microsecond to ~17 seconds, 4 buckets per doubling (~19% wide)
+BUCKET_EDGES = [1e-6 * 2 ** (i / 4.0) for i in range(97)]
+
+
+class LatencyHistogram:
+    """
+    Fixed log-spaced buckets, so recording is O(log buckets) and memory does not grow with the samples.
+    Percentiles are the upper edge of the bucket they fall in.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_EDGES) + 1)  # type: list
+        self.count = 0  # type: int
+        self.total = 0.0  # type: float
+        self.max = 0.0  # type: float
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(BUCKET_EDGES, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        """
+        :param percent: 0 - 100
+        :return: seconds
+        """
+        if self.count == 0:
+            return 0.0
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for bucket, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count > 0:
+                return min(BUCKET_EDGES[bucket], self.max) if bucket < len(BUCKET_EDGES) else self.max
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_ms': 1000 * self.total / self.count if self.count else 0.0,
+            'p50_ms': 1000 * self.percentile(50),
+            'p95_ms': 1000 * self.percentile(95),
+            'p99_ms': 1000 * self.percentile(99),
+            'max_ms': 1000 * self.max,
+        }
+
+
+class _NullTimer:
+    """What stage() returns while profiling is off"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _StageTimer:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StageProfiler:
+    """
+    Latency histograms of the stages of the frame pipeline.
+        with profiler.stage('warp'):
+            ...
+    Off by default: stage() then hands back a shared no-op context manager.
+    """
+
+    def __init__(self):
+        self.enabled = False  # type: bool
+        self.histograms = {}  # type: dict
+        # extra numbers published with the histograms, e.g. counters of other components
+        self.counters = {}  # type: dict
+        self.lock = threading.Lock()
+        # periodic dump file, see enable()
+        self.dump_path = None  # type: str
+        self.dump_interval = 5.0  # type: float
+        self.next_dump = 0.0  # type: float
+
+    def enable(self, dump_path=None, dump_interval=5.0):
+        self.enabled = True
+        self.dump_path = dump_path
+        self.dump_interval = dump_interval
+        self.next_dump = time.time() + dump_interval
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _StageTimer(self, name)
+
+    def record(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.record(seconds)
+
+    def summary(self):
+        """
+        :return: {'stages': {stage: {count, mean_ms, p50_ms, p95_ms, p99_ms, max_ms}}, 'counters': {...}}
+        """
+        with self.lock:
+            stages = dict((name, histogram.summary()) for name, histogram in self.histograms.items())
+        return {'stages': stages, 'counters': dict(self.counters)}
+
+    def dump(self, path):
+        with open(path, 'w') as dump_file:
+            json.dump(self.summary(), dump_file, indent=2, sort_keys=True)
+
+    def maybe_dump(self):
+        """
+        Write the dump file if one is configured and the interval passed. Call it once per frame
+        :return:
+        """
+        if self.dump_path is None or not self.enabled:
+            return
+        now = time.time()
+        if now >= self.next_dump:
+            self.next_dump = now + self.dump_interval
+            self.dump(self.dump_path)
+
+
+# the profiler every module records to
+profiler = StageProfiler()
@@ -0,0 +1,253 @@
+import json
+import os
+import queue
+import threading
+import numpy as np
+from supporting_functions import TelemetryRecord
+
+
+class TelemetryRecorder:
+    """
+    Records a run: every telemetry message, camera frame included, is appended as one JSON line
+    exactly as it was received, so a replay feeds update_rover the same data the simulator did.
+    """
+
+    def __init__(self, path):
+        self.path = path  # type: str
+        self.file = open(path, 'w')
+        self.frames = 0  # type: int
+
+    def record(self, data):
+        self.file.write(json.dumps(data))
+        self.file.write('\n')
+        self.frames += 1
+
+    def close(self):
+        self.file.close()
+
+
+class TelemetryRecording:
+    """
+    Reads a run recorded by TelemetryRecorder. The line offsets are indexed on open,
+    so any message (or range of messages) can be read without going through the file.
+    """
+
+    def __init__(self, path):
+        self.path = path  # type: str
+        self.offsets = []  # type: list
+        with open(path, 'rb') as recording:
+            offset = 0
+            for line in recording:
+                if line.strip():
+                    self.offsets.append(offset)
+                offset += len(line)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        return next(self.read(index, index + 1))
+
+    def __iter__(self):
+        return self.read()
+
+    def read(self, start=0, stop=None):
+        """
+        Iterate over the telemetry dictionaries of messages [start, stop)
+        :return:
+        """
+        start, stop, _ = slice(start, stop).indices(len(self.offsets))
+        if start >= stop:
+            return
+        with open(self.path, 'rb') as recording:
+            recording.seek(self.offsets[start])
+            for _ in range(start, stop):
+                yield json.loads(recording.readline().decode('utf-8'))
+
+
+# camera frame of the simulator
+IMAGE_SHAPE = (160, 320, 3)
+# one frame of a FrameRecorder chunk: the telemetry as numbers and the raw RGB camera image
+FRAME_FIELDS = [('time', np.float64), ('vel', np.float64), ('x', np.float64), ('y', np.float64),
+                ('yaw', np.float64), ('pitch', np.float64), ('roll', np.float64),
+                ('throttle', np.float64), ('steer', np.float64),
+                ('near_sample', np.int32), ('picking_up', np.int32), ('sample_count', np.int32)]
+INDEX_FILE = 'index.json'
+
+
+def frame_dtype(image_shape=IMAGE_SHAPE):
+    return np.dtype(FRAME_FIELDS + [('image', np.uint8, tuple(image_shape))])
+
+
+def chunk_path(folder, chunk):
+    return os.path.join(folder, 'chunk_{0:05d}.frames'.format(chunk))
+
+
+class FrameRecorder:
+    """
+    Records the decoded camera frames and the telemetry of a run into memory mapped chunk files of
+    chunk_frames fixed size frames each, preallocated when the chunk is started.
+    record() only copies the frame into a queue, a writer thread copies it into the chunk and the
+    OS writes the pages back, so the control loop never waits for the disk. When the writer falls
+    queue_size frames behind, frames are dropped and counted instead.
+    index.json describes the layout and is rewritten whenever a chunk is completed and on close.
+    """
+
+    def __init__(self, folder, chunk_frames=512, queue_size=64, image_shape=IMAGE_SHAPE):
+        self.folder = folder  # type: str
+        self.chunk_frames = chunk_frames  # type: int
+        self.dtype = frame_dtype(image_shape)
+        self.image_shape = tuple(image_shape)  # type: tuple
+        self.samples_pos = None  # type: tuple
+        self.frames = 0  # type: int
+        self.dropped = 0  # type: int
+        self.chunk = None  # type: np.memmap
+        self.queue = queue.Queue(queue_size)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.thread = threading.Thread(target=self.run, name='frame-recorder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, Rover):
+        """
+        Queue the current camera frame and telemetry of the rover
+        :param Rover: RoverState after update_rover
+        :return: False if the frame was dropped
+        """
+        if self.samples_pos is None and Rover.samples_pos is not None:
+            self.samples_pos = Rover.samples_pos
+        fields = (Rover.total_time, Rover.vel, Rover.pos[0], Rover.pos[1], Rover.yaw, Rover.pitch, Rover.roll,
+                  Rover.throttle, Rover.steer, Rover.near_sample, Rover.picking_up,
+                  Rover.samples_to_find - Rover.samples_found)
+        try:
+            # the decoder reuses its buffers, so the frame is copied
+            self.queue.put_nowait((fields, Rover.img.copy()))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            fields, image = item
+            offset = self.frames % self.chunk_frames
+            if offset == 0:
+                self.start_chunk(self.frames // self.chunk_frames)
+            self.chunk[offset] = fields + (image,)
+            self.frames += 1
+
+    def start_chunk(self, chunk):
+        if self.chunk is not None:
+            self.chunk.flush()
+            self.write_index()
+        self.chunk = np.memmap(chunk_path(self.folder, chunk), dtype=self.dtype, mode='w+',
+                               shape=(self.chunk_frames,))
+
+    def write_index(self):
+        index = {'frames': self.frames, 'chunk_frames': self.chunk_frames, 'image_shape': list(self.image_shape),
+                 'dropped': self.dropped}
+        if self.samples_pos is not None:
+            index['samples_x'] = [int(x) for x in self.samples_pos[0]]
+            index['samples_y'] = [int(y) for y in self.samples_pos[1]]
+        with open(os.path.join(self.folder, INDEX_FILE), 'w') as index_file:
+            json.dump(index, index_file)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.chunk is not None:
+            self.chunk.flush()
+        self.write_index()
+
+
+class FrameRecording:
+    """
+    Reads a run recorded by FrameRecorder. Frame i is in chunk i // chunk_frames, so any frame is found
+    without a scan, and images are NumPy views of the memory mapped chunks (no copy, no decoding).
+    """
+
+    def __init__(self, folder):
+        self.folder = folder  # type: str
+        with open(os.path.join(folder, INDEX_FILE)) as index_file:
+            index = json.load(index_file)
+        self.frames = index['frames']  # type: int
+        self.chunk_frames = index['chunk_frames']  # type: int
+        self.dtype = frame_dtype(index['image_shape'])
+        self.samples_pos = None  # type: tuple
+        if 'samples_x' in index:
+            self.samples_pos = (np.int_(index['samples_x']), np.int_(index['samples_y']))
+        # chunk number -> read only memmap, opened on first access
+        self.chunks = {}  # type: dict
+
+    def __getstate__(self):
+        # memmaps are opened again by each process
+        state = self.__dict__.copy()
+        state['chunks'] = {}
+        return state
+
+    def __len__(self):
+        return self.frames
+
+    def __getitem__(self, index):
+        return next(self.read(index, index + 1))
+
+    def __iter__(self):
+        return self.read()
+
+    def chunk(self, chunk):
+        memmap = self.chunks.get(chunk)
+        if memmap is None:
+            memmap = self.chunks[chunk] = np.memmap(chunk_path(self.folder, chunk), dtype=self.dtype, mode='r',
+                                                    shape=(self.chunk_frames,))
+        return memmap
+
+    def images(self, start=0, stop=None):
+        """
+        The camera images of frames [start, stop) as one array, a view when they are in the same chunk
+        :return: (frames, rows, cols, 3) uint8
+        """
+        start, stop, _ = slice(start, stop).indices(self.frames)
+        first, last = start // self.chunk_frames, (stop - 1) // self.chunk_frames
+        if first == last:
+            offset = first * self.chunk_frames
+            return self.chunk(first)['image'][start - offset:stop - offset]
+        return np.concatenate([self.images(max(start, chunk * self.chunk_frames),
+                                           min(stop, (chunk + 1) * self.chunk_frames))
+                               for chunk in range(first, last + 1)])
+
+    def read(self, start=0, stop=None):
+        """
+        Iterate over frames [start, stop)
+        :return: (TelemetryRecord, image view) pairs. The first record carries the sample positions
+        """
+        start, stop, _ = slice(start, stop).indices(self.frames)
+        for index in range(start, stop):
+            frame = self.chunk(index // self.chunk_frames)[index % self.chunk_frames]
+            record = TelemetryRecord()
+            record.vel = float(frame['vel'])
+            record.pos = [float(frame['x']), float(frame['y'])]
+            record.yaw = float(frame['yaw'])
+            record.pitch = float(frame['pitch'])
+            record.roll = float(frame['roll'])
+            record.throttle = float(frame['throttle'])
+            record.steer = float(frame['steer'])
+            record.near_sample = int(frame['near_sample'])
+            record.picking_up = int(frame['picking_up'])
+            record.sample_count = int(frame['sample_count'])
+            if index == 0:
+                record.samples_pos = self.samples_pos
+            yield record, frame['image']
+
+
+def open_recording(path):
+    """
+    :param path: a TelemetryRecorder file or a FrameRecorder folder
+    :return: TelemetryRecording or FrameRecording
+    """
+    if os.path.isdir(path):
+        return FrameRecording(path)
+    return TelemetryRecording(path)
@@ -0,0 +1,95 @@
+import copy
+import threading
+import time
+import numpy as np
+import logging
+from rocks import RockRegistry
+
+logger = logging.getLogger('main_app.renderer')
+
+
+class RenderSnapshot:
+    """
+    The part of a RoverState that create_output_images reads, copied so that it can be
+    rendered on another thread while the rover keeps updating.
+    """
+
+    def __init__(self, Rover):
+        stats = Rover.map_stats
+        if stats.ground_truth is None:
+            stats.set_ground_truth(Rover.ground_truth[:, :, 1] > 0)
+        self.worldmap = np.array(Rover.map_view())  # type: np.ndarray
+        self.map_stats = copy.copy(stats)
+        self.map_stats.cells = list(stats.cells)
+        self.map_stats.hits = list(stats.hits)
+        self.vision_image = Rover.vision_image.copy()  # type: np.ndarray
+        self.ground_truth = Rover.ground_truth  # type: np.ndarray
+        self.samples_pos = Rover.samples_pos
+        self.rocks = Rover.rocks.copy()  # type: RockRegistry
+        self.samples_found = Rover.samples_found  # type: int
+        self.total_time = Rover.total_time  # type: float
+
+    def map_view(self):
+        return self.worldmap
+
+
+class AsyncRenderer:
+    """
+    Produces the inset images on a background thread at a limited rate so that sending the
+    control commands never waits for the JPEG encoding.
+    Only the latest submitted state is rendered, older ones are dropped.
+    """
+
+    def __init__(self, render_function, rate=5.0, images=('', '')):
+        """
+        :param render_function: function(Rover) -> (image_string1, image_string2), i.e create_output_images
+        :param rate: renders per second
+        :param images: what latest returns before the first render, e.g. blank_inset_images()
+        """
+        self.render_function = render_function
+        self.interval = 1.0 / rate  # type: float
+        self.next_submit = 0  # type: float
+        self.pending = None  # type: RenderSnapshot
+        self.images = images  # type: tuple
+        self.rendered = 0  # type: int
+        self.dropped = 0  # type: int
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='renderer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, Rover):
+        """
+        Hand the current state to the worker if a render is due. Cheap when it is not.
+        :param Rover: RoverState
+        :return:
+        """
+        now = time.time()
+        if now < self.next_submit:
+            return
+        self.next_submit = now + self.interval
+        snapshot = RenderSnapshot(Rover)
+        with self.condition:
+            if self.pending is not None:
+                self.dropped += 1
+            self.pending = snapshot
+            self.condition.notify()
+
+    def latest(self):
+        """
+        The most recently rendered images (the initial images before the first render)
+        :return: image_string1, image_string2
+        """
+        return self.images
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                snapshot, self.pending = self.pending, None
+            try:
+                self.images = self.render_function(snapshot)
+                self.rendered += 1
+            except Exception:
+                logger.exception('rendering the inset images failed')
@@ -0,0 +1,106 @@
+# Replays a run recorded with drive_rover.py --record (or into an image folder) through the whole pipeline
+# without the simulator
+# and reports the throughput of every stage.
+# Example: $ python replay.py run.jsonl --repeat 3
+import argparse
+import logging
+import time
+import numpy as np
+from rover_state import RoverState
+from perception import perception_step, PerceptionContext
+from decision import decision_step
+from supporting_functions import update_rover, apply_telemetry, create_output_images, load_ground_truth
+from recording import open_recording
+
+STAGES = ['update_rover', 'perception_step', 'decision_step', 'create_output_images']
+
+
+def replay(recording, ground_truth, render=True, Rover=None):
+    """
+    Feed recorded telemetry through update_rover -> perception_step -> decision_step -> create_output_images
+    as fast as possible
+    :param recording: iterable of telemetry dictionaries, or of (TelemetryRecord, image) of a FrameRecording
+    :param ground_truth: 3 channel ground truth map
+    :param render: also run create_output_images
+    :param Rover: the RoverState to drive, a new one if None
+    :return: the Rover, {stage: list of seconds per frame}
+    """
+    if Rover is None:
+        Rover = RoverState(world_size=ground_truth.shape[0])
+        Rover.ground_truth = ground_truth
+    context = PerceptionContext()
+    timings = dict((stage, []) for stage in STAGES)
+    clock = time.perf_counter
+
+    for data in recording:
+        start = clock()
+        if isinstance(data, dict):
+            Rover, _ = update_rover(Rover, data)
+        else:
+            # frame recordings hold parsed telemetry and decoded images
+            record, Rover.img = data
+            apply_telemetry(Rover, record)
+        decoded = clock()
+        timings['update_rover'].append(decoded - start)
+        # same as telemetry in drive_rover.py: invalid telemetry is skipped
+        if not np.isfinite(Rover.vel):
+            continue
+        Rover = perception_step(Rover, context)
+        perceived = clock()
+        Rover = decision_step(Rover)
+        decided = clock()
+        timings['perception_step'].append(perceived - decoded)
+        timings['decision_step'].append(decided - perceived)
+        if render:
+            create_output_images(Rover)
+            timings['create_output_images'].append(clock() - decided)
+    return Rover, timings
+
+
+def format_report(timings):
+    """
+    One line per stage with frames, mean/max milliseconds and frames per second
+    :param timings: {stage: list of seconds}
+    :return:
+    """
+    lines = ['{0:<22}{1:>8}{2:>12}{3:>12}{4:>12}'.format('stage', 'frames', 'mean ms', 'max ms', 'fps')]
+    total = 0
+    for stage in STAGES:
+        seconds = timings.get(stage, [])
+        if len(seconds) == 0:
+            continue
+        mean = np.mean(seconds)
+        total += mean
+        lines.append('{0:<22}{1:>8}{2:>12.3f}{3:>12.3f}{4:>12.1f}'.format(
+            stage, len(seconds), 1000 * mean, 1000 * np.max(seconds), 1 / mean if mean > 0 else float('inf')))
+    if total > 0:
+        lines.append('{0:<22}{1:>8}{2:>12.3f}{3:>12}{4:>12.1f}'.format('pipeline', '', 1000 * total, '', 1 / total))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a recorded run headless and benchmark the pipeline')
+    parser.add_argument('recording', type=str,
+                        help='Telemetry file written by drive_rover.py --record, or a frame recording folder')
+    parser.add_argument('--repeat', type=int, default=1, help='Replay the run this many times.')
+    parser.add_argument('--no_render', action='store_true', help='Skip create_output_images.')
+    parser.add_argument('--verbose', action='store_true', help='Print the debug log of the rover and the decision step.')
+    args = parser.parse_args()
+
+    if args.verbose:
+        # the rover logs to main_app.* (see drive_rover.py), nothing is printed otherwise
+        logger = logging.getLogger('main_app')
+        logger.setLevel(logging.DEBUG)
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(name)s - %(levelname)s - %(message)s'))
+        logger.addHandler(handler)
+
+    recorded_run = open_recording(args.recording)
+    ground_truth_3d = load_ground_truth()
+    all_timings = dict((stage, []) for stage in STAGES)
+    for _ in range(args.repeat):
+        _, run_timings = replay(recorded_run, ground_truth_3d, render=not args.no_render)
+        for name in STAGES:
+            all_timings[name].extend(run_timings[name])
+    print('Replayed {0} messages x {1}'.format(len(recorded_run), args.repeat))
+    print(format_report(all_timings))
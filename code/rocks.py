@@ -0,0 +1,210 @@
+from math import floor, hypot
+
+
+class RockCandidate:
+    """
+    A cluster of rock detections, likely one rock sample
+    """
+    __slots__ = ('x', 'y', 'hits', 'first_seen', 'last_seen', 'collected', 'attempts')
+
+    def __init__(self, x, y, hits, time):
+        # mean position of the detections, in meters like Rover.pos
+        self.x = x  # type: float
+        self.y = y  # type: float
+        # number of detections merged into it
+        self.hits = hits  # type: int
+        self.first_seen = time  # type: float
+        self.last_seen = time  # type: float
+        # picked up by the rover
+        self.collected = False  # type: bool
+        # times the rover was sent to collect it
+        self.attempts = 0  # type: int
+
+    @property
+    def position(self):
+        return self.x, self.y
+
+    def __repr__(self):
+        return 'RockCandidate({0:.1f}, {1:.1f}, hits={2})'.format(self.x, self.y, self.hits)
+
+
+class RockRegistry:
+    """
+    The rock samples detected so far. Detections closer than merge_radius to a candidate are merged into it
+    (its position is the mean of the detections, its confidence grows with their number).
+    The candidates are kept in a grid hash of cell_size meters, so the nearest and the within radius queries
+    look at the few cells around the query point instead of every candidate.
+    """
+
+    def __init__(self, cell_size=3.0, merge_radius=2.0, confidence_hits=5):
+        """
+        :param cell_size: side of the hash cells in meters
+        :param merge_radius: detections closer than this (meters) to a candidate are the same rock
+        :param confidence_hits: detections that give a candidate a confidence of 0.5
+        """
+        self.cell_size = cell_size  # type: float
+        self.merge_radius = merge_radius  # type: float
+        self.confidence_hits = confidence_hits  # type: int
+        # (col, row) of the hash -> list of RockCandidate
+        self.grid = {}  # type: dict
+        self.candidates = []  # type: list
+        # the hash cells in use: min col, max col, min row, max row. Bounds the nearest search
+        self.extent = None  # type: tuple
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def __iter__(self):
+        return iter(self.candidates)
+
+    def copy(self):
+        """
+        A registry that later detections do not add to, e.g. for a RenderSnapshot
+        (the candidates are shared, so it sees their latest position)
+        :return: RockRegistry
+        """
+        registry = RockRegistry(self.cell_size, self.merge_radius, self.confidence_hits)
+        registry.grid = {cell: list(candidates) for cell, candidates in self.grid.items()}
+        registry.candidates = list(self.candidates)
+        registry.extent = self.extent
+        return registry
+
+    def key(self, x, y):
+        return int(floor(x / self.cell_size)), int(floor(y / self.cell_size))
+
+    def confidence(self, candidate):
+        """
+        :param candidate: RockCandidate
+        :return: in [0 1)
+        """
+        return candidate.hits / float(candidate.hits + self.confidence_hits)
+
+    def insert(self, candidate):
+        col, row = self.key(candidate.x, candidate.y)
+        self.grid.setdefault((col, row), []).append(candidate)
+        if self.extent is None:
+            self.extent = col, col, row, row
+        else:
+            min_col, max_col, min_row, max_row = self.extent
+            self.extent = min(min_col, col), max(max_col, col), min(min_row, row), max(max_row, row)
+
+    def add(self, position, hits=1, time=None):
+        """
+        Register a detection
+        :param position: (x, y) in meters
+        :param hits: weight of the detection, e.g. the hit count of a map cell
+        :param time: Rover.total_time of the detection
+        :return: the RockCandidate it was merged into
+        """
+        x, y = float(position[0]), float(position[1])
+        candidate = self.nearest((x, y), self.merge_radius, collected=True)
+        if candidate is None:
+            candidate = RockCandidate(x, y, hits, time)
+            self.candidates.append(candidate)
+            self.insert(candidate)
+            return candidate
+
+        old_key = self.key(candidate.x, candidate.y)
+        total = candidate.hits + hits
+        candidate.x += (x - candidate.x) * hits / total
+        candidate.y += (y - candidate.y) * hits / total
+        candidate.hits = total
+        candidate.last_seen = time
+        # the mean moved to another hash cell
+        if self.key(candidate.x, candidate.y) != old_key:
+            self.grid[old_key].remove(candidate)
+            self.insert(candidate)
+        return candidate
+
+    def nearest(self, position, max_distance=None, min_confidence=0.0, collected=False):
+        """
+        The closest candidate, searched ring by ring of hash cells around the position
+        :param position: (x, y) in meters
+        :param max_distance: only candidates closer than this (meters)
+        :param min_confidence: ignore less confident candidates
+        :param collected: include the collected rocks
+        :return: RockCandidate, None if there is none
+        """
+        if self.extent is None:
+            return None
+        x, y = position
+        col, row = self.key(x, y)
+        min_col, max_col, min_row, max_row = self.extent
+        # past this ring there are no cells in use
+        last_ring = max(col - min_col, max_col - col, row - min_row, max_row - row)
+        best, best_distance = None, float('inf') if max_distance is None else max_distance
+        ring = 0
+        # the cells of ring r are at least (r - 1) * cell_size away from the position
+        while ring <= last_ring and (ring - 1) * self.cell_size < best_distance:
+            for cell in ring_cells(col, row, ring):
+                for candidate in self.grid.get(cell, ()):
+                    if candidate.collected and not collected:
+                        continue
+                    distance = hypot(candidate.x - x, candidate.y - y)
+                    if distance < best_distance and self.confidence(candidate) >= min_confidence:
+                        best, best_distance = candidate, distance
+            ring += 1
+        return best
+
+    def within(self, position, radius, min_confidence=0.0, collected=False):
+        """
+        The candidates at most radius away
+        :param position: (x, y) in meters
+        :param radius: meters
+        :param min_confidence: ignore less confident candidates
+        :param collected: include the collected rocks
+        :return: list of (distance, RockCandidate), nearest first
+        """
+        x, y = position
+        min_col, min_row = self.key(x - radius, y - radius)
+        max_col, max_row = self.key(x + radius, y + radius)
+        found = []
+        for col in range(min_col, max_col + 1):
+            for row in range(min_row, max_row + 1):
+                for candidate in self.grid.get((col, row), ()):
+                    if candidate.collected and not collected:
+                        continue
+                    distance = hypot(candidate.x - x, candidate.y - y)
+                    if distance <= radius and self.confidence(candidate) >= min_confidence:
+                        found.append((distance, candidate))
+        found.sort(key=lambda item: item[0])
+        return found
+
+    def pending(self, position, radius, min_confidence=0.5, max_attempts=2):
+        """
+        The rocks still to collect around the rover, nearest first
+        :param position: (x, y) of the rover in meters
+        :param radius: meters
+        :param min_confidence: ignore less confident candidates (probably noise)
+        :param max_attempts: ignore the rocks the rover was sent to this many times already
+        :return: list of RockCandidate
+        """
+        return [candidate for _, candidate in self.within(position, radius, min_confidence)
+                if candidate.attempts < max_attempts]
+
+    def mark_collected(self, position, radius):
+        """
+        The rover picked up a rock: mark the nearest candidate collected
+        :param position: (x, y) of the rover in meters
+        :param radius: meters
+        :return: the RockCandidate, None if there is none that close
+        """
+        candidate = self.nearest(position, radius)
+        if candidate is not None:
+            candidate.collected = True
+        return candidate
+
+
+def ring_cells(col, row, ring):
+    """
+    The hash cells at Chebyshev distance ring from (col, row)
+    """
+    if ring == 0:
+        yield col, row
+        return
+    for offset in range(-ring, ring + 1):
+        yield col + offset, row - ring
+        yield col + offset, row + ring
+    for offset in range(-ring + 1, ring):
+        yield col - ring, row + offset
+        yield col + ring, row + offset
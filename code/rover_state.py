@@ -1,11 +1,19 @@
+import logging
 import numpy as np
 from utilities import distance, yaw_from_to
 from math import atan2, degrees
+from world_map import create_worldmap, display_view, MapStatistics, NavigationMap, HITS_PER_FRAME
+from window_features import WindowFeatures, navigation_counts
+from rocks import RockRegistry
+from commands import CommandQueue, Command, Mapping, GoYaw, GoForward, Collecting, Unstuck
+
+logger = logging.getLogger('main_app.rover')
 
 
 # Define RoverState() class to retain rover state parameters
 class RoverState:
-    def __init__(self):
+    def __init__(self, world_size=200, map_resolution=1, tiled_map=False, compact_maps=True,
+                 hits_per_frame=HITS_PER_FRAME):
         # To record the start time of navigation
         self.start_time = None  # type: float
         # To record total duration of navigation
@@ -58,7 +66,8 @@ class RoverState:
         # Image output from perception step
         # Update this image to display your intermediate analysis steps
         # on screen in autonomous mode
-        self.vision_image = np.zeros((160, 320, 3), dtype=np.float)  # type: np.ndarray
+        # compact_maps stores it as uint8 (it only holds 0/255 masks), otherwise as float
+        self.vision_image = np.zeros((160, 320, 3), dtype=np.uint8 if compact_maps else np.float64)  # type: np.ndarray
         # To store the actual sample positions
         self.samples_pos = None
         # To store the initial count of samples
@@ -73,8 +82,8 @@ class RoverState:
         self.started_picking_up = False  # type: bool
         # Set to True to trigger rock pickup
         self.send_pickup = False  # type: bool
-        # a list of pending commands for the robot
-        self.commands = ['mapping']  # type: list
+        # the pending commands for the robot, the executing one first (self.mode is its name)
+        self.commands = CommandQueue([Mapping()])  # type: CommandQueue
         # the departure_point the Robot started from
         self.departure_point = None  # type: tuple
         # robot starting point
@@ -90,16 +99,61 @@ class RoverState:
         # it has a position value IF I am seeing a rock on camera.
         self.seen_rock = None  # type: np.ndarray
         self.is_collecting = False  # type: bool
+        # every rock detected so far, clustered (see perception_step)
+        self.rocks = RockRegistry()  # type: RockRegistry
+        # drive to the rocks that were seen but not collected, if they are this close (meters)
+        self.rock_detour = 30.0  # type: float
         # Worldmap
         # Update this image with the positions of navigable terrain
-        # obstacles and rock samples
-        self.worldmap = np.zeros((200, 200, 3), dtype=np.float)  # type: np.ndarray
+        # obstacles and rock samples. It holds the hit count of every cell (see world_map.accumulate)
+        # with map_resolution cells per meter. Use map_view() for the one cell per meter map
+        # compact_maps uses a saturating uint16 counter instead of int32
+        self.map_resolution = map_resolution  # type: int
+        self.worldmap = create_worldmap(world_size, map_resolution, tiled_map,
+                                        dtype=np.uint16 if compact_maps else np.int32)  # type: np.ndarray
+        # statistics of the worldmap kept up to date by perception_step
+        self.map_stats = MapStatistics(world_size, map_resolution)  # type: MapStatistics
+        # the navigation codes of the map, kept up to date with the cells perception and update_state touch.
+        # hits_per_frame must match the scale of the PerceptionContext (PerceptionContext.hits_per_frame)
+        self.navigation = NavigationMap(world_size, map_resolution, dtype=np.int8 if compact_maps else np.int64,
+                                        hits_per_frame=hits_per_frame)  # type: NavigationMap
+        # what perception_step passes to accumulate
+        self.map_listeners = (self.map_stats, self.navigation)  # type: tuple
         # the current navigation map
-        self.navigation_map = None  # type: np.ndarray
-        # marks every point the robot has
-        self.visited_map = np.zeros((200, 200), dtype=np.float)  # type: np.ndarray
+        self.navigation_map = self.navigation.codes  # type: np.ndarray
+        # cells of the navigation map changed since the planner and the frontier search were updated
+        self.planning_changes = self.navigation.subscribe()
+        # marks every point the robot has (boolean with compact_maps)
+        self.visited_map = np.zeros((world_size, world_size),
+                                    dtype=np.bool_ if compact_maps else np.float64)  # type: np.ndarray
         # an array just to see which driving condition is triggered in the mapping function
         self.stats = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]  # type: list
+        # plans routes over the navigation map (planner.Planner). No planning if None
+        self.planner = None
+        # seconds between updates of the planner
+        self.planning_interval = 1.0  # type: float
+        self.next_planning = 0.0  # type: float
+        # go back to base after this many seconds, even if samples are missing (never if None)
+        self.return_time = None  # type: float
+        # the rover is driving the route back to base
+        self.returning = False  # type: bool
+        # finds the unexplored edges of the map (frontiers.FrontierSearch). Needs the planner
+        self.frontiers = None
+        # cells in a row the rover entered that were already visited, and after how many it goes exploring
+        self.revisited_cells = 0  # type: int
+        self.revisit_limit = 30  # type: int
+        self.last_cell = None  # type: tuple
+        # frames decided so far
+        self.frames = 0  # type: int
+        # counts of the vision_image windows the decisions use. register() more on it
+        self.window_features = WindowFeatures()  # type: WindowFeatures
+        # the window counts of the current frame, by window name
+        self.windows = dict((name, 0) for name in self.window_features.names)  # type: dict
+        # the navigation diagnostics of the current frame (see update_diagnostics)
+        self.navigation_counts = 0, 0, 0  # type: tuple
+        self.obstacles_left = 0, 0, 0  # type: tuple
+        self.obstacles_right = 0, 0, 0  # type: tuple
+        self.obstacles_center = 0, 0, 0, 0  # type: tuple
 
     def update_state(self):
         """
@@ -113,7 +167,12 @@ class RoverState:
             assert (self.pos is not None, "The robot position cannot be none")
             self.base = self.pos
         x, y = self.pos
-        self.visited_map[int(y), int(x)] = 1  # mark the position as visited
+        cell = int(y), int(x)
+        if cell != self.last_cell:  # entering a new cell: count how long the rover is on known ground
+            self.revisited_cells = self.revisited_cells + 1 if self.visited_map[cell] else 0
+            self.last_cell = cell
+        self.visited_map[cell] = 1  # mark the position as visited
+        self.navigation.visit(*cell)
 
         if self.stuck_counter == 0:  # handle stuck counter
             self.previous_position = self.pos  # change previous position when the robot has traveled
@@ -126,72 +185,88 @@ class RoverState:
         self.throttle = 0
         self.steer = 0
 
+        self.frames += 1
+        self.update_diagnostics()
+
+    def update_diagnostics(self):
+        """
+        The navigation angle and obstacle window counts of the current frame, computed once
+        for the decisions (mapping, trapped) and the logs (nav_info)
+        :return: 
+        """
+        self.windows = self.window_features.compute(self.vision_image)
+        self.navigation_counts = self.get_navigation_angles()
+        self.obstacles_left = self.get_obstacles_left()
+        self.obstacles_right = self.get_obstacles_right()
+        self.obstacles_center = self.get_obstacles_center()
+
     def next_cycle(self):
         """
         The loop the state machine does to execute the command that is on top of the stack
         First handling if the robot is stuck somewhere
         :return: 
         """
+        # the command that finished last cycle leaves before anything is pushed in front of it
+        if self.mode == 'finished-command':
+            self.commands.pop()
+            self.mode = 'waiting-command'
+
         # handling stuck robot
         if self.stuck_counter > self.stuck_threshold and self.mode not in ['unstuck', 'collecting']:
-            self.commands = ['unstuck'] + self.commands  # put it in front
-            self.mode = 'waiting-command'
+            self.preempt(Unstuck())
         elif self.stuck_counter < self.stuck_threshold and self.mode == 'unstuck':
             self.mode = 'finished-command'
 
+        if self.planner is not None:
+            self.update_planning()
+
         if self.seen_rock is not None and not self.is_collecting:
-            self.commands = ['collecting'] + self.commands
-            self.mode = 'waiting-command'
+            self.preempt(Collecting())
             self.is_collecting = True
 
         if self.mode == 'waiting-command':
             if len(self.commands) != 0:  # there are still commands to execute
-                self.mode = self.commands[0]  # this is one of the known commands that is_executing knows to handle
+                self.mode = self.commands.current.name  # the command dispatch will execute
             else:  # no commands so lets find new points
                 pass
-        elif self.mode == 'finished-command':
-            self.commands.pop(0)
-            self.mode = 'waiting-command'
         elif self.is_executing_command():
             self.finish_pending_command()
 
+    def preempt(self, command):
+        # type: (Command) -> None
+        """
+        Queue a command in front of those of lower priority, and switch to it if it is first now
+        :param command: Command
+        :return: 
+        """
+        if self.commands.preempt(command):
+            self.mode = 'waiting-command'
+
     def finish_pending_command(self):
         """
-        Interpreting the command on top of the stuck and calling the corresponding function
+        Calling the handler of the command on top of the stack (COMMAND_HANDLERS)
         :return: 
         """
-        if self.mode.startswith('go-forward'):
-            self.go_forward()
-        elif self.mode.startswith('go-yaw'):
-            self.go_yaw()
-        elif self.mode == 'mapping':
-            self.mapping()
-        elif self.mode == 'unstuck':
-            self.unstuck()
-        elif self.mode == 'collecting':
-            self.collect()
+        self.commands.dispatch(COMMAND_HANDLERS, self)
 
     def is_executing_command(self):
         """
-        Is a known command executed
+        Is the command on top of the stack executed
         :return: 
         """
-        if self.mode.startswith('go-forward') or self.mode.startswith('go-yaw'):
-            return True
-        if self.mode in ['mapping', 'unstuck', 'stopping', 'collecting']:
-            return True
-        return False
+        current = self.commands.current
+        return current is not None and self.mode == current.name
 
-    def mapping(self):
+    def mapping(self, command=None):
         """
         This function handles the navigation of the robot. Its a "crawl left wall" strategy mostly
         :return: 
         """
 
-        left, center, right = self.get_navigation_angles()
-        bottom_close_l, middle_far_l, up_far_l = self.get_obstacles_left()
-        bottom_close_r, middle_far_r, up_far_r = self.get_obstacles_right()
-        center_close, center_far, center_left, center_right = self.get_obstacles_center()
+        left, center, right = self.navigation_counts
+        bottom_close_l, middle_far_l, up_far_l = self.obstacles_left
+        bottom_close_r, middle_far_r, up_far_r = self.obstacles_right
+        center_close, center_far, center_left, center_right = self.obstacles_center
 
         if center_close > 50:  # getting close to hit a wall
             self.stats[1] += 1
@@ -237,9 +312,10 @@ class RoverState:
         else:
             pass
 
-    def go_yaw(self):
+    def go_yaw(self, command):
+        # type: (GoYaw) -> None
         """
-        Will execute a 'go-yaw value' command and will turn the robot at the desired yaw
+        Will execute a GoYaw command and will turn the robot at the desired yaw
         Needs more tests.
         """
         if self.vel > 0:
@@ -248,7 +324,7 @@ class RoverState:
         else:
             pass
 
-        target_yaw = float(self.mode.split()[1])  # command is go-yaw angle. always in [-pi pi]
+        target_yaw = command.yaw  # always in [-pi pi]
         steering = yaw_from_to(self.yaw, target_yaw)
 
         if abs(steering) < 0.1:  # completed turning
@@ -257,13 +333,13 @@ class RoverState:
         else:
             self.throttle = 0
             self.steer = min(max(steering, -15), 15)
-            self.mode = self.commands[0]
 
-    def go_forward(self):
-        """Will drive the Robot one square ahead"""
+    def go_forward(self, command):
+        # type: (GoForward) -> None
+        """Will drive the Robot command.meters ahead"""
 
         self.brake = 0
-        meters = float(self.mode.split()[1])  # command is go-forward 10
+        meters = command.meters
 
         # current position of robot
         x, y = self.pos[0], self.pos[1]
@@ -272,7 +348,7 @@ class RoverState:
             self.departure_point = (x, y)
 
         current_distance = distance((x, y), self.departure_point)
-        print(current_distance)
+        logger.debug('go-forward %s: %.2f m traveled', meters, current_distance)
 
         # check the distance the robot has traveled
         if meters - current_distance < 0.1:
@@ -281,9 +357,8 @@ class RoverState:
             self.mode = 'finished-command'
         else:
             self.throttle = 0.5
-            self.mode = self.commands[0]
 
-    def unstuck(self):
+    def unstuck(self, command=None):
         if self.mode == 'collecting':
             extra_wait = 300
             if self.stuck_counter < self.stuck_threshold + extra_wait:
@@ -297,40 +372,40 @@ class RoverState:
     def unstuck_strategy(self, strategy):
         if strategy == 1:
             # try steering the other way
-            print("FRONT STUCK")
+            logger.debug('unstuck: FRONT STUCK')
             self.steer = 0
             self.throttle = 10
         elif strategy == 2:
             # try steering the other way
-            print("STUCK - RIGHT BACK")
+            logger.debug('unstuck: STUCK - RIGHT BACK')
             self.steer = np.random.uniform(-13, -15)
             self.throttle = -10
         elif strategy == 3:
-            print("STUCK - LEFT BACK")
+            logger.debug('unstuck: STUCK - LEFT BACK')
             self.steer = np.random.uniform(13, 15)
             self.throttle = -10
         elif strategy == 4:
             # try steering the other way
-            print("FRONT RIGHT-STUCK")
+            logger.debug('unstuck: FRONT RIGHT-STUCK')
             self.steer = np.random.uniform(-13, -15)
             self.throttle = 0
         elif strategy == 5:
             # try steering the other way
-            print("FRONT LEFT-STUCK")
+            logger.debug('unstuck: FRONT LEFT-STUCK')
             self.steer = np.random.uniform(13, 15)
             self.throttle = 0
         elif strategy == 6:
             # try steering the other way
-            print("FRONT RIGHT-WITH-SPEED-STUCK")
+            logger.debug('unstuck: FRONT RIGHT-WITH-SPEED-STUCK')
             self.steer = np.random.uniform(-13, -15)
             self.throttle = 10
         elif strategy == 7:
             # try steering the other way
-            print("FRONT LEFT-WITH-SPEED-STUCK")
+            logger.debug('unstuck: FRONT LEFT-WITH-SPEED-STUCK')
             self.steer = np.random.uniform(13, 15)
             self.throttle = 10
 
-    def collect(self):
+    def collect(self, command=None):
         self.is_collecting = True
 
         if self.picking_up:
@@ -341,6 +416,7 @@ class RoverState:
             self.send_pickup = True
         elif not self.picking_up and self.started_picking_up:
             # finished picking up
+            self.rocks.mark_collected(self.pos, 3.0)
             self.started_picking_up = False
             self.seen_rock = None
             self.is_collecting = False
@@ -351,8 +427,7 @@ class RoverState:
 
             # self.steer = np.clip(yaw_diff, -15, 15)
             self.steer = np.clip(np.mean(self.rock_angles * 180 / np.pi), -15, 15)
-            print("YAW DIFFERENCE {0}".format(yaw_diff))
-            print("ROCK ANGLE {0}".format(self.steer))
+            logger.debug('collecting: yaw difference %s, rock angle %s', yaw_diff, self.steer)
             if self.vel > 1.0:
                 self.brake = 1
             elif 0.5 <= self.vel <= 1:
@@ -374,43 +449,132 @@ class RoverState:
         Return how many driving angles are available for center left and right
         :return: 
         """
-        center = len(self.nav_angles[(-0.1 <= self.nav_angles) & (self.nav_angles <= 0.1)])
-        left = len(self.nav_angles[self.nav_angles > 0.1])
-        right = len(self.nav_angles[self.nav_angles < -0.1])
+        left, center, right = navigation_counts(self.nav_angles)
 
         return left, center, right
 
+    # the obstacle windows are counted by update_diagnostics (see window_features.DEFAULT_WINDOWS)
     def get_obstacles_left(self):
-        bottom_close = np.count_nonzero(self.vision_image[145:160, 150:155, 0])
-        middle_far = np.count_nonzero(self.vision_image[135:145, 130:145, 0])
-        up_far = np.count_nonzero(self.vision_image[125:135, 130:145, 0])
-        return bottom_close, middle_far, up_far
+        windows = self.windows
+        return windows['left_bottom_close'], windows['left_middle_far'], windows['left_up_far']
 
     def get_obstacles_right(self):
-        bottom_close = np.count_nonzero(self.vision_image[145:160, 165:170, 0])
-        middle_far = np.count_nonzero(self.vision_image[135:145, 175:190, 0])
-        up_far = np.count_nonzero(self.vision_image[125:135, 175:190, 0])
-        return bottom_close, middle_far, up_far
+        windows = self.windows
+        return windows['right_bottom_close'], windows['right_middle_far'], windows['right_up_far']
 
     def get_obstacles_center(self):
-        center_close = np.count_nonzero(self.vision_image[140:150, 150:170, 0])
-        center_far = np.count_nonzero(self.vision_image[120:140, 150:170, 0])
-        center_left = np.count_nonzero(self.vision_image[140:150, 130:160, 0])
-        center_right = np.count_nonzero(self.vision_image[140:150, 160:190, 0])
-        return center_close, center_far, center_left, center_right
+        windows = self.windows
+        return windows['center_close'], windows['center_far'], windows['center_left'], windows['center_right']
+
+    def map_view(self):
+        """
+        The worldmap with one cell per meter, whatever its resolution and storage
+        :return: 
+        """
+        return display_view(self.worldmap, self.map_resolution)
 
     def generate_exploration_map(self):
-        # init the map
-        self.navigation_map = np.full(self.worldmap[:, :, 0].shape, -1)  # unknown or empty
-        accessibility_condition = (self.worldmap[:, :, 2] > self.worldmap[:, :, 0]) & (self.worldmap[:, :, 2] > 10)
-        obstacles_condition = (self.worldmap[:, :, 0] > self.worldmap[:, :, 2]) & (self.worldmap[:, :, 0] > 10)
-        visited_condition = (self.visited_map[:, :] == 1)
-        self.navigation_map[accessibility_condition] = 0  # terrain
-        self.navigation_map[obstacles_condition] = -2  # obstacles
-        self.navigation_map[visited_condition] = 1  # visited
+        """
+        Bring navigation_map up to date: -1 unknown or empty, 0 terrain, -2 obstacles, 1 visited.
+        Only the cells accumulated into or visited since the last call are reclassified (see NavigationMap)
+        :return: flat indices of the cells whose code changed
+        """
+        changed = self.navigation.refresh()
+        self.navigation_map = self.navigation.codes
+        return changed
+
+    def update_planning(self):
+        """
+        Keeps the distance field of the planner up to date and heads back to base when the mission is over
+        :return: 
+        """
+        if self.total_time is None or self.total_time < self.next_planning:
+            return
+        self.next_planning = self.total_time + self.planning_interval
+        self.refresh_planning()
+        if not self.returning and self.mission_complete():
+            self.return_to_base()
+        elif self.mode == 'mapping' and not self.returning and self.collect_next_rock():
+            pass
+        elif self.frontiers is not None and self.mode == 'mapping' and self.revisited_cells >= self.revisit_limit:
+            self.explore()
+
+    def explore(self):
+        """
+        The wall crawl keeps driving over mapped ground: put the route to the best frontier in front of the commands
+        :return: True if a frontier could be reached
+        """
+        self.revisited_cells = 0
+        for frontier in self.frontiers.clusters(self.pos):
+            route = self.planner.route(self.pos, frontier.target)
+            if route is not None:
+                self.commands.push_front(self.planner.commands(route))
+                self.mode = 'waiting-command'
+                return True
+        return False
+
+    def collect_next_rock(self):
+        """
+        Drive to the nearest rock of the registry that was seen but not collected (e.g. while busy collecting
+        another one). Collecting takes over when it is in sight again
+        :return: True if there is a route to one
+        """
+        for rock in self.rocks.pending(self.pos, self.rock_detour):
+            rock.attempts += 1
+            if self.go_to(rock.position):
+                logger.debug('going to collect %s', rock)
+                return True
+        return False
+
+    def refresh_planning(self):
+        """
+        Hand the navigation map cells that changed since the last call to the planner and the frontier search
+        :return: 
+        """
+        self.generate_exploration_map()
+        changed = self.planning_changes.take()
+        self.planner.update(self.navigation_map, self.base, changed)
+        if self.frontiers is not None:
+            self.frontiers.update(self.navigation_map, changed)
+
+    def mission_complete(self):
+        """
+        All samples collected or out of time
+        :return: 
+        """
+        if self.return_time is not None and self.total_time >= self.return_time:
+            return True
+        return self.samples_to_find > 0 and self.samples_found >= self.samples_to_find
+
+    def return_to_base(self):
+        """
+        Replace the commands with the shortest known route to the base
+        :return: True if there is a route over the mapped terrain
+        """
+        route = self.planner.route_to_base(self.pos)
+        if route is None:
+            return False
+        self.commands.replace(self.planner.commands(route))
+        self.mode = 'waiting-command'
+        self.returning = True
+        return True
+
+    def go_to(self, target):
+        """
+        Put the A* route to a point of the map in front of the commands
+        :param target: (x, y) in meters
+        :return: True if there is a route over the mapped terrain
+        """
+        self.refresh_planning()
+        route = self.planner.route(self.pos, target)
+        if route is None:
+            return False
+        self.commands.push_front(self.planner.commands(route))
+        self.mode = 'waiting-command'
+        return True
 
     def trapped(self):
-        left, center, right = self.get_navigation_angles()
+        left, center, right = self.navigation_counts
 
         trapped = 0
         trapped = trapped + 1 if center < 30 else trapped
@@ -418,18 +582,31 @@ class RoverState:
         trapped = trapped + 1 if right < 30 else trapped
         return trapped
 
-    def print_nav_info(self):
-        left, center, right = self.get_navigation_angles()
-        print("Current Mode: {0}".format(self.mode))
-        print("Commands: {0!s}".format(self.commands))
-        print("CENTER: {0}  RIGHT: {1} LEFT: {2}".format(center, right, left))
-        print("Stuck counter: {0} , Trapped: {1}".format(self.stuck_counter, self.trapped()))
-        print("Velocity: {0} , Throttle: {1} Brakes: {2}".format(self.vel, self.throttle, self.brake))
-        print("Obstacles Left  bottom-close {0} , middle-far {1}, up-far {2}".format(*self.get_obstacles_left()))
-        print("Obstacles right  bottom-close {0} , middle-far {1}, up-far {2}".format(*self.get_obstacles_right()))
-        print("Obstacles center  center-close {0} , center-far {1},"
-              " center-left {2}, center-right {3}".format(*self.get_obstacles_center()))
-        print("Strategy Stats: {0!s}".format(self.stats))
-
-        if self.seen_rock is not None:
-            print("-------------ROCK ON SIGHT ----------------------")
+    def nav_info(self):
+        """
+        The state and diagnostics of the current frame as a dictionary, for the structured logs
+        :return: 
+        """
+        left, center, right = self.navigation_counts
+        return {
+            'mode': self.mode,
+            'commands': [str(command) for command in self.commands],
+            'nav_center': center, 'nav_right': right, 'nav_left': left,
+            'stuck_counter': self.stuck_counter, 'trapped': self.trapped(),
+            'velocity': self.vel, 'throttle': self.throttle, 'brake': self.brake,
+            'obstacles_left': self.obstacles_left,
+            'obstacles_right': self.obstacles_right,
+            'obstacles_center': self.obstacles_center,
+            'strategy_stats': list(self.stats),
+            'rock_on_sight': self.seen_rock is not None,
+        }
+
+
+# the handler of every command type, called by CommandQueue.dispatch with (rover, command)
+COMMAND_HANDLERS = {
+    Mapping: RoverState.mapping,
+    GoYaw: RoverState.go_yaw,
+    GoForward: RoverState.go_forward,
+    Collecting: RoverState.collect,
+    Unstuck: RoverState.unstuck,
+}
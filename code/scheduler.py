@@ -0,0 +1,167 @@
+import time
+from profiling import profiler
+
+
+class FramePlan:
+    """
+    Which of the expensive stages run on a frame. The steering inputs (nav angles, obstacle windows)
+    and the decision run unless the frame is dropped (the last commands are sent again).
+    """
+    __slots__ = ('update_map', 'render', 'drop')
+
+    def __init__(self, update_map=True, render=True, drop=False):
+        self.update_map = update_map  # type: bool
+        self.render = render  # type: bool
+        self.drop = drop  # type: bool
+
+    def kind(self):
+        if self.drop:
+            return 'drop'
+        return 'full' if self.update_map and self.render else 'map' if self.update_map else 'cheap'
+
+
+class FrameScheduler:
+    """
+    Keeps the telemetry handler within the simulator frame interval.
+
+    Messages that arrive while a frame is processed wait in the socket, so when frames cost more than the
+    interval the rover acts on older and older images. The scheduler estimates that lag with the queue
+    recursion lag = max(0, lag + previous cost - interval), where the interval is measured between
+    messages that found the handler idle (the time between them over the messages that came in between).
+    A frame that starts behind by a whole interval only gets the cheap steering path, so the queue drains
+    and the newest frame is processed in full. When even the cheap path does not fit in the interval
+    (or the lag reaches max_lag) the frames that start behind are dropped.
+    Otherwise the expensive stages run when the time saved on cheaper frames covers their cost
+    (a token bucket of interval - cost per frame). A full (rendered) frame runs whenever the credit covers it.
+    After a map only frame the credit is saved for a full one, so the map update cannot use up the credit
+    a render needs.
+
+        plan = scheduler.begin()
+        ... perception with plan.update_map, rendering if plan.render ...
+        scheduler.end(plan)
+    """
+
+    def __init__(self, interval=None, headroom=0.9, smoothing=0.1, max_lag=4, clock=time.perf_counter):
+        """
+        :param interval: frame interval of the simulator in seconds, measured if None
+        :param headroom: fraction of the interval a frame may use
+        :param smoothing: weight of the last sample in the moving averages
+        :param max_lag: frames that start this many intervals late are dropped
+        :param clock: function() -> seconds
+        """
+        self.clock = clock
+        self.max_lag = max_lag  # type: float
+        self.interval = interval  # type: float
+        self.measure_interval = interval is None  # type: bool
+        self.headroom = headroom  # type: float
+        self.smoothing = smoothing  # type: float
+        # average cost of each FramePlan.kind(), learned as the kinds run
+        self.costs = {'drop': 0.0, 'cheap': 0.0, 'map': 0.0, 'full': 0.0}  # type: dict
+        self.credit = 0.0  # type: float
+        # a map only frame ran since the last full frame: save the credit for a full one
+        self.saving = False  # type: bool
+        self.lag = 0.0  # type: float
+        self.last_start = None  # type: float
+        self.last_end = None  # type: float
+        self.last_cost = 0.0  # type: float
+        # start and number of the last message that found the handler idle
+        self.last_idle_start = None  # type: float
+        self.last_idle_frame = 0  # type: int
+        self.start = 0.0  # type: float
+        # metrics
+        self.frames = 0  # type: int
+        self.lagging = 0  # type: int
+        self.skipped_map = 0  # type: int
+        self.skipped_render = 0  # type: int
+        self.dropped = 0  # type: int
+
+    def average(self, current, sample):
+        return sample if current == 0.0 else current + self.smoothing * (sample - current)
+
+    def extra_cost(self, kind):
+        """
+        What a plan costs over the cheap path (0 until both have been measured)
+        """
+        if self.costs[kind] == 0.0 or self.costs['cheap'] == 0.0:
+            return 0.0
+        return max(self.costs[kind] - self.costs['cheap'], 0.0)
+
+    def begin(self):
+        """
+        Call when a telemetry message comes in
+        :return: FramePlan for this frame
+        """
+        now = self.clock()
+        self.frames += 1
+        # messages queued behind this one, as far as we know
+        behind = False
+        # the handler was idle before this message: nothing is queued, and it started when it arrived
+        idle = self.last_start is None or now - self.last_end > 0.1 * self.last_cost
+        if idle:
+            self.lag = 0.0
+            if self.measure_interval and self.last_idle_start is not None:
+                # every message between the two idle ones went through begin
+                sample = (now - self.last_idle_start) / (self.frames - self.last_idle_frame)
+                self.interval = self.average(self.interval or 0.0, sample)
+            self.last_idle_start, self.last_idle_frame = now, self.frames
+        elif self.interval:
+            self.lag = max(0.0, self.lag + self.last_cost - self.interval)
+            behind = self.lag >= self.interval
+        else:
+            # back to back before the interval could be measured: drain the queue to find it
+            behind = True
+        self.start = now
+
+        if behind:
+            # this message is stale and newer ones are waiting: steer and move on
+            self.lagging += 1
+            if not self.interval or self.costs['cheap'] >= self.interval or self.lag >= self.max_lag * self.interval:
+                # steering would not drain the queue either (or the interval is still unknown): drop the frame
+                self.dropped += 1
+                plan = FramePlan(False, False, drop=True)
+            else:
+                plan = FramePlan(False, False)
+        elif not self.interval:
+            plan = FramePlan()
+        else:
+            budget = self.headroom * self.interval
+            # capped, but so that even a full frame costlier than the budget is afforded now and then
+            self.credit = min(self.credit + budget - self.costs['cheap'], max(budget, self.extra_cost('full')))
+            if self.credit >= self.extra_cost('full'):
+                plan = FramePlan(True, True)
+                self.saving = False
+            elif not self.saving and self.credit >= self.extra_cost('map'):
+                plan = FramePlan(True, False)
+                self.saving = True
+            else:
+                # cheap while the credit builds up for a full frame
+                plan = FramePlan(False, False)
+
+        self.skipped_map += not plan.update_map
+        self.skipped_render += not plan.render
+        return plan
+
+    def end(self, plan):
+        """
+        Call when the frame is done (commands sent)
+        :param plan: the FramePlan begin returned
+        :return:
+        """
+        self.last_end = self.clock()
+        self.last_start = self.start
+        self.last_cost = self.last_end - self.start
+        kind = plan.kind()
+        self.costs[kind] = self.average(self.costs[kind], self.last_cost)
+        if kind in ('map', 'full') and self.interval:
+            self.credit -= self.extra_cost(kind)
+        self.publish()
+
+    def publish(self):
+        counters = profiler.counters
+        counters['frames'] = self.frames
+        counters['frames_lagging'] = self.lagging
+        counters['frames_skipped_map'] = self.skipped_map
+        counters['frames_skipped_render'] = self.skipped_render
+        counters['frames_dropped'] = self.dropped
+        counters['lag_ms'] = 1000 * self.lag
+        counters['frame_interval_ms'] = 1000 * (self.interval or 0.0)
@@ -3,71 +3,227 @@ import cv2
 from PIL import Image
 from io import BytesIO, StringIO
 import base64
+import os
 import time
+import matplotlib.image as mpimg
 from rover_state import RoverState
 import logging
+from profiling import profiler
 
 logger = logging.getLogger('main_app.supporting_functions')
-logger.setLevel(logging.DEBUG)
+
+
+GROUND_TRUTH_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calibration_images', 'map_bw.png')
+
+
+def load_ground_truth(path=GROUND_TRUTH_PATH):
+    """
+    Read in ground truth map and create 3-channel green version for over plotting
+    NOTE: images are read in by default with the origin (0, 0) in the upper left
+    and y-axis increasing downward.
+    :param path: the black and white ground truth map
+    :return: 
+    """
+    ground_truth = mpimg.imread(path)
+    # This next line creates arrays of zeros in the red and blue channels
+    # and puts the map into the green channel.  This is why the underlying
+    # map output looks green in the display image
+    return np.dstack((ground_truth * 0, ground_truth * 255, ground_truth * 0)).astype(np.float64)
 
 
 # Define a function to convert telemetry strings to float independent of decimal convention
 def convert_to_float(string_to_convert):
     if ',' in string_to_convert:
-        float_value = np.float(string_to_convert.replace(',', '.'))
+        float_value = float(string_to_convert.replace(',', '.'))
     else:
-        float_value = np.float(string_to_convert)
+        float_value = float(string_to_convert)
     return float_value
 
 
-def update_rover(Rover, data):
+class TelemetryRecord:
+    """
+    The typed scalar fields of one telemetry message
+    """
+    __slots__ = ('vel', 'pos', 'yaw', 'pitch', 'roll', 'throttle', 'steer',
+                 'near_sample', 'picking_up', 'sample_count', 'samples_pos')
+
+    def __init__(self):
+        self.vel = 0.0  # type: float
+        self.pos = None  # type: list
+        self.yaw = 0.0  # type: float
+        self.pitch = 0.0  # type: float
+        self.roll = 0.0  # type: float
+        self.throttle = 0.0  # type: float
+        self.steer = 0.0  # type: float
+        self.near_sample = 0  # type: int
+        self.picking_up = 0  # type: int
+        self.sample_count = 0  # type: int
+        # only parsed when asked for (the first message)
+        self.samples_pos = None  # type: tuple
+
+
+class TelemetryParser:
+    """
+    Parses telemetry dictionaries into TelemetryRecord in one pass.
+    The decimal convention is detected once: numbers are parsed with float() until one fails
+    because of a decimal comma, from then on commas are replaced before parsing.
+    """
+
+    def __init__(self):
+        self.decimal_comma = False  # type: bool
+
+    def to_float(self, string_to_convert):
+        if self.decimal_comma:
+            return float(string_to_convert.replace(',', '.'))
+        try:
+            return float(string_to_convert)
+        except ValueError:
+            if ',' not in string_to_convert:
+                raise
+            self.decimal_comma = True
+            return float(string_to_convert.replace(',', '.'))
+
+    def parse(self, data, samples=False):
+        """
+        :param data: telemetry dictionary
+        :param samples: also parse the sample positions
+        :return: TelemetryRecord
+        """
+        to_float = self.to_float
+        record = TelemetryRecord()
+        record.vel = to_float(data["speed"])
+        x, y = data["position"].split(';')
+        record.pos = [to_float(x), to_float(y)]
+        record.yaw = to_float(data["yaw"])
+        record.pitch = to_float(data["pitch"])
+        record.roll = to_float(data["roll"])
+        record.throttle = to_float(data["throttle"])
+        record.steer = to_float(data["steering_angle"])
+        record.near_sample = int(data["near_sample"])
+        record.picking_up = int(data["picking_up"])
+        record.sample_count = int(data["sample_count"])
+        if samples:
+            record.samples_pos = (np.int_([to_float(pos) for pos in data["samples_x"].split(';')]),
+                                  np.int_([to_float(pos) for pos in data["samples_y"].split(';')]))
+        return record
+
+
+telemetry_parser = TelemetryParser()
+
+
+class EncodedFrame:
+    """
+    A camera frame as it came in the telemetry (JPEG bytes). The PIL image is only built when it is asked for
+    """
+
+    def __init__(self, data):
+        self.data = data  # type: bytes
+
+    def to_pil(self):
+        return Image.open(BytesIO(self.data))
+
+    def save(self, filename):
+        """
+        Save the frame. A .jpg file gets the received bytes as they are
+        :param filename: path of the image file
+        :return: 
+        """
+        if filename.lower().endswith(('.jpg', '.jpeg')):
+            with open(filename, 'wb') as image_file:
+                image_file.write(self.data)
+        else:
+            self.to_pil().save(filename)
+
+
+# decode JPEGs straight to RGB (OpenCV >= 4.10)
+IMREAD_COLOR_RGB = getattr(cv2, 'IMREAD_COLOR_RGB', None)
+
+
+class FrameDecoder:
+    """
+    Decodes base64 JPEG camera frames with OpenCV.
+    cv2.imdecode has no output argument in Python, so every frame still allocates the decoded image
+    (160x320x3 bytes). With OpenCV >= 4.10 it is decoded straight to RGB and returned as is.
+    Older versions decode to BGR and convert into preallocated RGB buffers, used round robin,
+    so a frame stays valid until `buffers` more frames are decoded.
+    """
+
+    def __init__(self, buffers=2):
+        self.buffers = [None] * buffers  # type: list
+        self.index = 0  # type: int
+
+    def decode(self, image_string):
+        """
+        :param image_string: base64 encoded JPEG
+        :return: RGB image (a new array, or a reused buffer with older OpenCV), EncodedFrame of the JPEG bytes
+        """
+        data = base64.b64decode(image_string)
+        if IMREAD_COLOR_RGB is not None:
+            return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), IMREAD_COLOR_RGB), EncodedFrame(data)
+        bgr = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        self.index = (self.index + 1) % len(self.buffers)
+        rgb = self.buffers[self.index]
+        if rgb is None or rgb.shape != bgr.shape:
+            rgb = self.buffers[self.index] = np.empty_like(bgr)
+        cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=rgb)
+        return rgb, EncodedFrame(data)
+
+
+frame_decoder = FrameDecoder()
+
+
+def apply_telemetry(Rover, record):
+    """
+    Copy a parsed telemetry record to the rover state
+    :param Rover: RoverState
+    :param record: TelemetryRecord (with samples_pos on the first message)
+    :return: 
+    """
     # Initialize start time and sample positions
-    if Rover.start_time == None:
+    if Rover.start_time is None:
         Rover.start_time = time.time()
         Rover.total_time = 0
-        samples_xpos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_x"].split(';')])
-        samples_ypos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_y"].split(';')])
-        Rover.samples_pos = (samples_xpos, samples_ypos)
-        Rover.samples_to_find = np.int(data["sample_count"])
+        Rover.samples_pos = record.samples_pos
+        Rover.samples_to_find = record.sample_count
     # Or just update elapsed time
     else:
         tot_time = time.time() - Rover.start_time
         if np.isfinite(tot_time):
             Rover.total_time = tot_time
-    # Print out the fields in the telemetry data dictionary
-    # print(data.keys())
     # The current speed of the rover in m/s
-    Rover.vel = convert_to_float(data["speed"])
+    Rover.vel = record.vel
     # The current position of the rover
-    Rover.pos = [convert_to_float(pos.strip()) for pos in data["position"].split(';')]
-    # The current yaw angle of the rover
-    Rover.yaw = convert_to_float(data["yaw"])
-    # The current yaw angle of the rover
-    Rover.pitch = convert_to_float(data["pitch"])
-    # The current yaw angle of the rover
-    Rover.roll = convert_to_float(data["roll"])
+    Rover.pos = record.pos
+    # The current yaw, pitch and roll angles of the rover
+    Rover.yaw = record.yaw
+    Rover.pitch = record.pitch
+    Rover.roll = record.roll
     # The current throttle setting
-    Rover.throttle = convert_to_float(data["throttle"])
+    Rover.throttle = record.throttle
     # The current steering angle
-    Rover.steer = convert_to_float(data["steering_angle"])
+    Rover.steer = record.steer
     # Near sample flag
-    Rover.near_sample = np.int(data["near_sample"])
+    Rover.near_sample = record.near_sample
     # Picking up flag
-    Rover.picking_up = np.int(data["picking_up"])
+    Rover.picking_up = record.picking_up
     # Update number of rocks found
-    Rover.samples_found = Rover.samples_to_find - np.int(data["sample_count"])
+    Rover.samples_found = Rover.samples_to_find - record.sample_count
+
+    # the message is only formatted if debug logging is on
+    logger.debug('speed = %s, position = %s, throttle = %s, steer_angle = %s, near_sample = %s, picking_up = %s,'
+                 ' total time = %s, samples remaining: %s, samples found: %s',
+                 Rover.vel, Rover.pos, Rover.throttle, Rover.steer, Rover.near_sample, record.picking_up,
+                 Rover.total_time, record.sample_count, Rover.samples_found)
+
 
-    logger.debug(
-        'speed = {0}, position = {1}, throttle = {2}, '
-        'steer_angle = {3}, near_sample = {4}, picking_up = {5} ,'
-        ' total time = {6}, samples remaining: {7}, samples found: {8} '.format(
-            Rover.vel, Rover.pos, Rover.throttle, Rover.steer,
-            Rover.near_sample, data["picking_up"], Rover.total_time, data["sample_count"], Rover.samples_found))
+def update_rover(Rover, data):
+    record = telemetry_parser.parse(data, samples=Rover.start_time is None)
+    apply_telemetry(Rover, record)
 
     # Get the current image from the center camera of the rover
     imgString = data["image"]
-    image = Image.open(BytesIO(base64.b64decode(imgString)))
-    Rover.img = np.asarray(image)
+    with profiler.stage('decode'):
+        Rover.img, image = frame_decoder.decode(imgString)
 
     # Return updated Rover and separate image for optional saving
     return Rover, image  # Define a function to create display output given worldmap results
@@ -75,54 +231,55 @@ def update_rover(Rover, data):
 
 # Define a function to create display output given worldmap results
 def create_output_images(Rover):
+    with profiler.stage('create_output_images'):
+        return _create_output_images(Rover)
+
+
+def _create_output_images(Rover):
+    worldmap = Rover.map_view()
+    # The normalisation and the statistics come from the counters perception_step keeps up to date
+    stats = Rover.map_stats
+    if stats.ground_truth is None:
+        stats.set_ground_truth(Rover.ground_truth[:, :, 1] > 0)
     # Create a scaled map for plotting and clean up obs/nav pixels a bit
-    if np.max(Rover.worldmap[:, :, 2]) > 0:
-        nav_pix = Rover.worldmap[:, :, 2] > 0
-        navigable = Rover.worldmap[:, :, 2] * (255 / np.mean(Rover.worldmap[nav_pix, 2]))
+    if stats.cells[2] > 0:
+        navigable = worldmap[:, :, 2] * (255 / stats.mean(2))
     else:
-        navigable = Rover.worldmap[:, :, 2]
-    if np.max(Rover.worldmap[:, :, 0]) > 0:
-        obs_pix = Rover.worldmap[:, :, 0] > 0
-        obstacle = Rover.worldmap[:, :, 0] * (255 / np.mean(Rover.worldmap[obs_pix, 0]))
+        navigable = worldmap[:, :, 2]
+    if stats.cells[0] > 0:
+        obstacle = worldmap[:, :, 0] * (255 / stats.mean(0))
     else:
-        obstacle = Rover.worldmap[:, :, 0]
+        obstacle = worldmap[:, :, 0]
 
     likely_nav = navigable >= obstacle
     obstacle[likely_nav] = 0
-    plotmap = np.zeros_like(Rover.worldmap)
+    plotmap = np.zeros(worldmap.shape, dtype=np.float64)
     plotmap[:, :, 0] = obstacle
     plotmap[:, :, 2] = navigable
     plotmap = plotmap.clip(0, 255)
     # Overlay obstacle and navigable terrain map with ground truth map
     map_add = cv2.addWeighted(plotmap, 1, Rover.ground_truth, 0.5, 0)
 
-    # Check whether any rock detections are present in worldmap
-    rock_world_pos = Rover.worldmap[:, :, 1].nonzero()
+    # Check whether any rock detections are present in the rock registry
     # If there are, we'll step through the known sample positions
     # to confirm whether detections are real
-    if rock_world_pos[0].any():
+    if len(Rover.rocks) > 0:
         rock_size = 2
-        for idx in range(len(Rover.samples_pos[0])):
-            test_rock_x = Rover.samples_pos[0][idx]
-            test_rock_y = Rover.samples_pos[1][idx]
-            rock_sample_dists = np.sqrt((test_rock_x - rock_world_pos[1]) ** 2 + \
-                                        (test_rock_y - rock_world_pos[0]) ** 2)
+        for test_rock_x, test_rock_y in zip(Rover.samples_pos[0], Rover.samples_pos[1]):
             # If rocks were detected within 3 meters of known sample positions
             # consider it a success and plot the location of the known
             # sample on the map
-            if np.min(rock_sample_dists) < 3:
+            if Rover.rocks.nearest((test_rock_x, test_rock_y), 3, collected=True) is not None:
                 map_add[test_rock_y - rock_size:test_rock_y + rock_size,
                 test_rock_x - rock_size:test_rock_x + rock_size, :] = 255
 
     # Calculate some statistics on the map results
-    # First get the total number of pixels in the navigable terrain map
-    tot_nav_pix = np.float(len((plotmap[:, :, 2].nonzero()[0])))
-    # Next figure out how many of those correspond to ground truth pixels
-    good_nav_pix = np.float(len(((plotmap[:, :, 2] > 0) & (Rover.ground_truth[:, :, 1] > 0)).nonzero()[0]))
-    # Next find how many do not correspond to ground truth pixels
-    bad_nav_pix = np.float(len(((plotmap[:, :, 2] > 0) & (Rover.ground_truth[:, :, 1] == 0)).nonzero()[0]))
-    # Grab the total number of map pixels
-    tot_map_pix = np.float(len((Rover.ground_truth[:, :, 1].nonzero()[0])))
+    # The total number of pixels in the navigable terrain map
+    tot_nav_pix = float(stats.cells[2])
+    # How many of those correspond to ground truth pixels
+    good_nav_pix = float(stats.good_nav_pix)
+    # The total number of map pixels
+    tot_map_pix = float(stats.tot_map_pix)
     # Calculate the percentage of ground truth map that has been successfully found
     perc_mapped = round(100 * good_nav_pix / tot_map_pix, 1)
     # Calculate the number of good map pixel detections divided by total pixels
@@ -132,7 +289,8 @@ def create_output_images(Rover):
     else:
         fidelity = 0
     # Flip the map for plotting so that the y-axis points upward in the display
-    map_add = np.flipud(map_add).astype(np.float32)
+    # (converted to the 8 bit display format once, the text and the JPEG encoder both work on it)
+    map_add = np.flipud(map_add).astype(np.uint8)
     # Add some text about map and rock sample detection results
     cv2.putText(map_add, "Time: " + str(np.round(Rover.total_time, 1)) + ' s', (0, 10),
                 cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
@@ -144,14 +302,28 @@ def create_output_images(Rover):
                 cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
 
     # Convert map and vision image to base64 strings for sending to server
-    pil_img = Image.fromarray(map_add.astype(np.uint8))
-    buff = BytesIO()
-    pil_img.save(buff, format="JPEG")
-    encoded_string1 = base64.b64encode(buff.getvalue()).decode("utf-8")
+    encoded_string1 = encode_image(map_add)
+    encoded_string2 = encode_image(np.asarray(Rover.vision_image, dtype=np.uint8))
 
-    pil_img = Image.fromarray(Rover.vision_image.astype(np.uint8))
+    return encoded_string1, encoded_string2
+
+
+def encode_image(image):
+    """
+    :param image: uint8 image
+    :return: base64 JPEG string, the format of the inset images
+    """
+    pil_img = Image.fromarray(image)
     buff = BytesIO()
     pil_img.save(buff, format="JPEG")
-    encoded_string2 = base64.b64encode(buff.getvalue()).decode("utf-8")
+    return base64.b64encode(buff.getvalue()).decode("utf-8")
 
-    return encoded_string1, encoded_string2
+
+def blank_inset_images(world_size=200):
+    """
+    Black map and vision images, sent until the first ones are rendered
+    :param world_size: side of the map image
+    :return: image_string1, image_string2
+    """
+    return (encode_image(np.zeros((world_size, world_size, 3), dtype=np.uint8)),
+            encode_image(np.zeros((160, 320, 3), dtype=np.uint8)))
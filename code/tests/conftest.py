@@ -0,0 +1,11 @@
+"""
+Unit tests of the perception, planning, scheduling, map and rock modules. Headless, no simulator needed.
+
+Run from the code folder:
+    python -m pytest tests
+"""
+import os
+import sys
+
+CODE_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, CODE_FOLDER)
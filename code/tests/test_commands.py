@@ -0,0 +1,56 @@
+from commands import CommandQueue, Mapping, GoYaw, GoForward, Collecting, Unstuck
+from rover_state import RoverState
+
+
+def test_commands_print_like_the_old_strings():
+    assert str(GoYaw(45.0)) == 'go-yaw 45'
+    assert str(GoForward(2.5)) == 'go-forward 2.5'
+    assert str(CommandQueue([Unstuck(), Mapping()])) == "['unstuck', 'mapping']"
+
+
+def test_preempt_inserts_by_priority():
+    queue = CommandQueue([GoYaw(10.0), GoForward(3.0), Mapping()], hooks=())
+    assert queue.preempt(Collecting())
+    assert queue.preempt(Unstuck())
+    assert not queue.preempt(Collecting())
+    assert [command.name for command in queue] == ['unstuck', 'collecting', 'collecting', 'go-yaw', 'go-forward',
+                                                   'mapping']
+
+
+def test_batches_keep_their_order():
+    queue = CommandQueue([Mapping()], hooks=())
+    queue.push_front([GoYaw(1.0), GoForward(2.0)])
+    assert [str(command) for command in queue] == ['go-yaw 1', 'go-forward 2', 'mapping']
+    queue.replace([GoForward(5.0)])
+    assert [str(command) for command in queue] == ['go-forward 5']
+    assert queue.pop().meters == 5.0
+    assert queue.current is None
+
+
+def test_dispatch_calls_the_handler_of_the_type_and_the_hooks():
+    timed = []
+    queue = CommandQueue([GoForward(4.0)], hooks=(lambda command, seconds: timed.append(command.name),))
+    calls = []
+    queue.dispatch({GoForward: lambda rover, command: calls.append((rover, command.meters))}, 'rover')
+    assert calls == [('rover', 4.0)]
+    assert timed == ['go-forward']
+
+
+def test_a_rock_seen_as_a_command_finishes_does_not_keep_it():
+    Rover = RoverState()
+    Rover.commands = CommandQueue([GoYaw(10.0), Mapping()], hooks=())
+    Rover.mode = 'finished-command'
+    Rover.seen_rock = (10, 10)
+    Rover.next_cycle()
+    assert [command.name for command in Rover.commands] == ['collecting', 'mapping']
+    assert Rover.mode == 'collecting'
+
+
+def test_stuck_rover_preempts_with_unstuck():
+    Rover = RoverState()
+    Rover.commands = CommandQueue([GoForward(3.0), Mapping()], hooks=())
+    Rover.mode = 'go-forward'
+    Rover.stuck_counter = Rover.stuck_threshold + 1
+    Rover.next_cycle()
+    assert Rover.mode == 'unstuck'
+    assert [command.name for command in Rover.commands] == ['unstuck', 'go-forward', 'mapping']
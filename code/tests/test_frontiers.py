@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from frontiers import FrontierSearch, frontier_cells
+from world_map import NavigationMap
+
+UNKNOWN, TERRAIN, OBSTACLE, VISITED = (NavigationMap.UNKNOWN, NavigationMap.TERRAIN, NavigationMap.OBSTACLE,
+                                       NavigationMap.VISITED)
+
+
+def test_frontier_cells_are_known_passable_cells_next_to_unknown():
+    navigation_map = np.full((5, 5), UNKNOWN)
+    navigation_map[1:4, 1:4] = TERRAIN
+    navigation_map[2, 2] = VISITED
+    navigation_map[1, 2] = OBSTACLE
+    frontier = frontier_cells(navigation_map)
+    expected = np.zeros((5, 5), dtype=bool)
+    expected[1, 1] = expected[1, 3] = expected[2, 1] = expected[2, 3] = True
+    expected[3, 1:4] = True
+    assert np.array_equal(frontier, expected)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_incremental_update_matches_full_recompute(seed):
+    rng = np.random.default_rng(seed)
+    navigation_map = rng.choice([UNKNOWN, TERRAIN, OBSTACLE, VISITED], (30, 30))
+    search = FrontierSearch()
+    search.update(navigation_map)
+    for step in range(30):
+        before = navigation_map.copy()
+        cells = rng.integers(0, navigation_map.size, rng.integers(1, 10))
+        navigation_map.reshape(-1)[cells] = rng.choice([UNKNOWN, TERRAIN, OBSTACLE, VISITED], len(cells))
+        changed = np.flatnonzero(navigation_map != before)
+        search.update(navigation_map, changed if step % 2 else None)
+        assert np.array_equal(search.frontier, frontier_cells(navigation_map))
+
+
+def test_clusters_prefer_large_close_groups():
+    navigation_map = np.full((40, 40), UNKNOWN)
+    navigation_map[:, :20] = TERRAIN
+    # a long edge at column 19 and a small pocket far away
+    navigation_map[35:38, 2:5] = UNKNOWN
+    search = FrontierSearch(min_size=3, min_distance=1.0)
+    search.update(navigation_map)
+    clusters = search.clusters((10.5, 10.5))
+    assert len(clusters) == 2
+    assert clusters[0].size > clusters[1].size
+    assert clusters[0].score >= clusters[1].score
+    # the target is the cell of the group closest to the rover
+    assert clusters[0].target == (19.5, 10.5)
+
+
+def test_clusters_skip_small_and_close_groups():
+    navigation_map = np.full((20, 20), TERRAIN)
+    navigation_map[5, 5] = UNKNOWN
+    search = FrontierSearch(min_size=3, min_distance=3.0)
+    search.update(navigation_map)
+    # the 4 cells around the unknown one are too close to the rover
+    assert search.clusters((5.5, 5.5)) == []
+    assert len(search.clusters((15.5, 15.5))) == 1
@@ -0,0 +1,74 @@
+import os
+import cv2
+import numpy as np
+import pytest
+from perception import (ColorClassifier, PerceptionContext, color_threshold, obstacles_threshold,
+                        rocks_threshold, perception_batch, perception_step)
+from rover_state import RoverState
+from world_map import MapStatistics, create_worldmap, display_view
+
+CALIBRATION_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'calibration_images')
+CALIBRATION_IMAGES = ['example_grid1.jpg', 'example_grid2.jpg', 'example_rock1.jpg', 'example_rock2.jpg']
+
+
+def read_rgb(name):
+    return cv2.cvtColor(cv2.imread(os.path.join(CALIBRATION_FOLDER, name)), cv2.COLOR_BGR2RGB)
+
+
+def thresholds(img):
+    """
+    The three threshold functions with the values perception_step used before ColorClassifier
+    """
+    return (color_threshold(img, rgb_thresh=(160, 160, 160)),
+            obstacles_threshold(img, threshold_high=(160, 160, 100), threshold_low=(0, 0, 0)),
+            rocks_threshold(img))
+
+
+@pytest.mark.parametrize('name', CALIBRATION_IMAGES)
+def test_classifier_views_match_the_threshold_functions(name):
+    classifier = ColorClassifier()
+    # the camera image and the birds view perception_step classifies
+    for img in (read_rgb(name), PerceptionContext().warp(read_rgb(name))):
+        views = classifier.views(classifier.classify(img))
+        for view, expected in zip(views, thresholds(img)):
+            assert view.dtype == expected.dtype
+            np.testing.assert_array_equal(view, expected)
+
+
+def test_a_stack_is_classified_like_its_frames():
+    classifier = ColorClassifier()
+    frames = np.stack([read_rgb(name) for name in CALIBRATION_IMAGES])
+    labels = classifier.classify(frames)
+    for index, frame in enumerate(frames):
+        np.testing.assert_array_equal(labels[index], classifier.classify(frame))
+
+
+@pytest.mark.parametrize('compact_maps', [True, False])
+@pytest.mark.parametrize('resolution, tiled_map', [(1, False), (3, True)])
+def test_batch_maps_like_perception_step(compact_maps, resolution, tiled_map):
+    random = np.random.RandomState(1)
+    count = 12
+    frames = np.stack([read_rgb(CALIBRATION_IMAGES[index % 4]) for index in range(count)])
+    xpos, ypos = 90 + 20 * random.rand(count), 80 + 20 * random.rand(count)
+    yaw = 360 * random.rand(count)
+    # a few frames are not level and must not be mapped
+    pitch = np.where(random.rand(count) > 0.2, 0.3, 5.0)
+    roll = np.where(random.rand(count) > 0.2, 359.5, 3.0)
+
+    Rover = RoverState(map_resolution=resolution, tiled_map=tiled_map, compact_maps=compact_maps)
+    for index in range(count):
+        Rover.img = frames[index]
+        Rover.pos = [xpos[index], ypos[index]]
+        Rover.yaw, Rover.pitch, Rover.roll = yaw[index], pitch[index], roll[index]
+        perception_step(Rover, PerceptionContext())
+
+    worldmap = create_worldmap(200, resolution, tiled_map, dtype=np.uint16 if compact_maps else np.int32)
+    stats = MapStatistics(200, resolution)
+    mapped = perception_batch(frames, xpos, ypos, yaw, pitch, roll, worldmap, PerceptionContext(), resolution,
+                              stats)
+    level = ((roll <= 1.0) | (roll >= 359.0)) & ((pitch <= 1.0) | (pitch >= 359.0))
+    assert mapped == np.count_nonzero(level)
+    np.testing.assert_array_equal(display_view(worldmap, resolution), Rover.map_view())
+    assert stats.cells == Rover.map_stats.cells
+    assert stats.hits == Rover.map_stats.hits
+    np.testing.assert_array_equal(stats.seen, Rover.map_stats.seen)
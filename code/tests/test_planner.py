@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+from planner import Planner, a_star, passable_cells, route_commands, simplify
+from commands import GoYaw, GoForward
+from world_map import NavigationMap
+
+UNKNOWN, TERRAIN, OBSTACLE = NavigationMap.UNKNOWN, NavigationMap.TERRAIN, NavigationMap.OBSTACLE
+
+
+def random_map(rng, size=40, blocked=0.25):
+    navigation_map = np.full((size, size), TERRAIN, dtype=np.int64)
+    navigation_map[rng.random((size, size)) < blocked] = OBSTACLE
+    return navigation_map
+
+
+def full_recompute(navigation_map, base):
+    planner = Planner()
+    planner.update(navigation_map, base)
+    return planner.distances
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_incremental_update_matches_full_recompute(seed):
+    rng = np.random.default_rng(seed)
+    navigation_map = random_map(rng)
+    base = (20.5, 20.5)
+    planner = Planner()
+    planner.update(navigation_map, base)
+    for step in range(40):
+        # open and block a few cells at random, like the map does while the rover drives
+        cells = rng.integers(0, navigation_map.size, rng.integers(1, 12))
+        before = navigation_map.copy()
+        navigation_map.reshape(-1)[cells] = rng.choice([TERRAIN, OBSTACLE, UNKNOWN], len(cells))
+        changed = np.flatnonzero(navigation_map != before)
+        planner.update(navigation_map, base, changed if step % 2 else None)
+        expected = full_recompute(navigation_map, base)
+        assert np.array_equal(np.isfinite(planner.distances), np.isfinite(expected))
+        finite = np.isfinite(expected)
+        assert np.allclose(planner.distances[finite], expected[finite], rtol=0, atol=1e-9)
+
+
+def test_a_star_goes_around_obstacles():
+    navigation_map = np.full((5, 5), TERRAIN)
+    navigation_map[1:5, 2] = OBSTACLE
+    route = a_star(passable_cells(navigation_map), (4, 0), (4, 4))
+    assert route[0] == (4, 0) and route[-1] == (4, 4)
+    assert all(navigation_map[cell] != OBSTACLE for cell in route)
+    assert (0, 2) in route
+
+
+def test_a_star_without_route():
+    navigation_map = np.full((5, 5), TERRAIN)
+    navigation_map[:, 2] = OBSTACLE
+    assert a_star(passable_cells(navigation_map), (0, 0), (0, 4)) is None
+
+
+def test_route_to_base_follows_the_distance_field():
+    navigation_map = np.full((10, 10), TERRAIN)
+    planner = Planner()
+    planner.update(navigation_map, (0.5, 0.5))
+    route = planner.route_to_base((9.5, 9.5))
+    assert route[0] == (9, 9) and route[-1] == (0, 0)
+    assert planner.distance_to_base((9.5, 9.5)) == pytest.approx(9 * np.sqrt(2))
+
+
+def test_route_commands():
+    navigation_map = np.full((10, 10), TERRAIN)
+    passable = passable_cells(navigation_map)
+    commands = route_commands(simplify(passable, a_star(passable, (0, 0), (0, 5))))
+    assert [type(command) for command in commands] == [GoYaw, GoForward]
+    assert commands[0].yaw == 0.0 and commands[1].meters == 5.0
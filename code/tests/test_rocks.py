@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from rocks import RockRegistry
+
+
+@pytest.fixture
+def registry():
+    rng = np.random.default_rng(0)
+    registry = RockRegistry()
+    for position in rng.uniform(0, 200, (500, 2)):
+        registry.add(position, time=0.0)
+    return registry
+
+
+def brute_force(registry, position):
+    positions = np.array([candidate.position for candidate in registry])
+    return np.hypot(positions[:, 0] - position[0], positions[:, 1] - position[1])
+
+
+def test_queries_match_brute_force(registry):
+    rng = np.random.default_rng(1)
+    for position in rng.uniform(-20, 220, (200, 2)):
+        distances = brute_force(registry, position)
+        nearest = registry.nearest(position)
+        assert np.hypot(nearest.x - position[0], nearest.y - position[1]) == pytest.approx(distances.min())
+        assert (registry.nearest(position, 3.0) is None) == (distances.min() >= 3.0)
+        assert len(registry.within(position, 10.0)) == np.count_nonzero(distances <= 10.0)
+
+
+def test_detections_of_a_rock_merge_into_one_candidate():
+    registry = RockRegistry(merge_radius=2.0, confidence_hits=5)
+    for offset in [(0, 0), (1, 0), (0, 1), (1, 1), (0.5, 0.5)]:
+        candidate = registry.add((50 + offset[0], 80 + offset[1]), time=1.0)
+    assert len(registry) == 1
+    assert candidate.position == pytest.approx((50.5, 80.5))
+    assert registry.confidence(candidate) == pytest.approx(0.5)
+    registry.add((60, 80))
+    assert len(registry) == 2
+
+
+def test_pending_rocks_skip_collected_and_unconfirmed_ones():
+    registry = RockRegistry(confidence_hits=5)
+    near = registry.add((10, 10), hits=10)
+    far = registry.add((30, 10), hits=10)
+    registry.add((12, 20), hits=1)
+    assert registry.pending((0, 10), 50.0) == [near, far]
+    assert registry.mark_collected((11, 10), 3.0) is near
+    assert registry.pending((0, 10), 50.0) == [far]
+    far.attempts = 2
+    assert registry.pending((0, 10), 50.0) == []
+    # collected rocks still confirm the sample positions
+    assert registry.nearest((10, 11), 3.0, collected=True) is near
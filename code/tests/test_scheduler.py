@@ -0,0 +1,59 @@
+from scheduler import FrameScheduler, FramePlan
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def simulate(costs, frames=3000, interval=1 / 30.0):
+    """
+    Messages arrive every interval and wait while the handler is busy, like in the socket
+    :param costs: seconds per FramePlan.kind()
+    :return: the scheduler, {kind: frames}, the largest lag seen (seconds)
+    """
+    clock = SimulatedClock()
+    scheduler = FrameScheduler(clock=clock)
+    kinds = dict.fromkeys(costs, 0)
+    busy_until, worst_lag = 0.0, 0.0
+    for frame in range(frames):
+        arrival = frame * interval
+        clock.now = max(arrival, busy_until)
+        worst_lag = max(worst_lag, clock.now - arrival)
+        plan = scheduler.begin()
+        kinds[plan.kind()] += 1
+        clock.now += costs[plan.kind()]
+        scheduler.end(plan)
+        busy_until = clock.now
+    return scheduler, kinds, worst_lag
+
+
+def test_renders_when_map_and_render_do_not_fit_every_frame():
+    _, kinds, worst_lag = simulate({'drop': 0.0, 'cheap': 0.010, 'map': 0.030, 'full': 0.050})
+    # the map update does not use up the credit of the renders: both run regularly (full frames update the map)
+    assert kinds['full'] > 0.3 * 3000
+    assert kinds['map'] + kinds['full'] > 0.5 * 3000
+    assert worst_lag < 0.2
+
+
+def test_everything_runs_when_it_fits():
+    _, kinds, _ = simulate({'drop': 0.0, 'cheap': 0.005, 'map': 0.010, 'full': 0.015})
+    assert kinds['full'] > 0.95 * 3000
+
+
+def test_drops_frames_when_the_cheap_path_is_too_slow():
+    scheduler, kinds, worst_lag = simulate({'drop': 0.001, 'cheap': 0.040, 'map': 0.045, 'full': 0.050})
+    assert kinds['drop'] > 0
+    # the lag stays bounded instead of growing with the run
+    assert worst_lag < 0.5
+    assert scheduler.lag < 0.5
+
+
+def test_plan_kinds():
+    assert FramePlan().kind() == 'full'
+    assert FramePlan(True, False).kind() == 'map'
+    assert FramePlan(False, False).kind() == 'cheap'
+    assert FramePlan(False, False, drop=True).kind() == 'drop'
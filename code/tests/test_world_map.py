@@ -0,0 +1,83 @@
+import tracemalloc
+import numpy as np
+import pytest
+from world_map import (NavigationMap, MapStatistics, HITS_PER_FRAME, accumulate, create_worldmap,
+                       display_view, hits_per_frame)
+
+
+def test_cells_are_confirmed_over_several_frames():
+    navigation = NavigationMap(world_size=10, resolution=2, confirm_frames=3)
+    # the 4 worldmap cells of display cell (1, 1) at resolution 2
+    cells = np.array([2 * 20 + 2, 2 * 20 + 3, 3 * 20 + 2, 3 * 20 + 3])
+    frame_hits = np.full(4, HITS_PER_FRAME // 4)
+    for frame in range(3):
+        navigation.update(2, cells, frame_hits)
+        navigation.refresh()
+        assert navigation.codes[1, 1] == NavigationMap.UNKNOWN
+    navigation.update(2, cells, frame_hits)
+    assert list(navigation.refresh()) == [11]
+    assert navigation.codes[1, 1] == NavigationMap.TERRAIN
+
+
+def test_obstacles_win_with_more_hits_and_visits_win_over_both():
+    navigation = NavigationMap(world_size=10, resolution=1, confirm_frames=1)
+    navigation.update(2, np.array([5]), np.array([2 * HITS_PER_FRAME]))
+    navigation.update(0, np.array([5]), np.array([3 * HITS_PER_FRAME]))
+    navigation.refresh()
+    assert navigation.codes[0, 5] == NavigationMap.OBSTACLE
+    navigation.visit(0, 5)
+    navigation.refresh()
+    assert navigation.codes[0, 5] == NavigationMap.VISITED
+
+
+
+def test_the_confirmation_threshold_follows_the_perception_scale():
+    # a meter is scale x scale warped pixels: twice the scale, four times the hits
+    assert hits_per_frame(20) == 4 * HITS_PER_FRAME
+    navigation = NavigationMap(world_size=10, resolution=1, confirm_frames=1, hits_per_frame=hits_per_frame(20))
+    navigation.update(2, np.array([5]), np.array([2 * HITS_PER_FRAME]))
+    navigation.refresh()
+    assert navigation.codes[0, 5] == NavigationMap.UNKNOWN
+    navigation.update(2, np.array([5]), np.array([3 * HITS_PER_FRAME]))
+    navigation.refresh()
+    assert navigation.codes[0, 5] == NavigationMap.TERRAIN
+
+
+def test_subscribers_get_the_changed_cells():
+    navigation = NavigationMap(world_size=10, resolution=1, confirm_frames=1)
+    feed = navigation.subscribe()
+    navigation.update(2, np.array([3, 4]), np.array([2 * HITS_PER_FRAME, 1]))
+    navigation.refresh()
+    assert list(feed.take()) == [3]
+    assert len(feed.take()) == 0
+
+
+@pytest.mark.parametrize('tiled', [False, True])
+def test_listeners_get_the_hits_a_saturated_map_kept(tiled):
+    worldmap = create_worldmap(20, 1, tiled, dtype=np.uint16)
+    stats = MapStatistics(20, 1)
+    rows, cols = np.array([3] * 40000 + [4]), np.array([5] * 40000 + [6])
+    for _ in range(2):
+        accumulate(worldmap, rows, cols, 2, stats)
+    view = display_view(worldmap, 1)
+    assert view[3, 5, 2] == np.iinfo(np.uint16).max
+    assert stats.hits[2] == int(view[:, :, 2].sum(dtype=np.int64))
+
+
+def test_far_apart_cells_need_memory_for_their_tiles_only():
+    # 20000 x 20000 cells: a bincount over the span of two opposite corners would take 3.2 GB
+    worldmap = create_worldmap(2000, 10, tiled=True, dtype=np.int32)
+    rows, cols = np.array([0, 19999]), np.array([0, 19999])
+    # the first call allocates numpy's one-off internals
+    accumulate(worldmap, rows, cols, 2)
+    worldmap.tiles.clear()
+    tracemalloc.start()
+    try:
+        accumulate(worldmap, rows, cols, 2)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert len(worldmap.tiles) == 2
+    # the two 160x160x3 int32 tiles are 600 KB
+    assert peak < 4 * 1024 * 1024
+    assert worldmap.view()[0, 0, 2] == worldmap.view()[1999, 1999, 2] == 1
@@ -0,0 +1,87 @@
+import cv2
+import numpy as np
+
+# vision_image channels
+OBSTACLES = 0
+ROCKS = 1
+TERRAIN = 2
+
+# the windows of vision_image the driving decisions look at: name -> (channel, top, bottom, left, right)
+DEFAULT_WINDOWS = [
+    ('left_bottom_close', (OBSTACLES, 145, 160, 150, 155)),
+    ('left_middle_far', (OBSTACLES, 135, 145, 130, 145)),
+    ('left_up_far', (OBSTACLES, 125, 135, 130, 145)),
+    ('right_bottom_close', (OBSTACLES, 145, 160, 165, 170)),
+    ('right_middle_far', (OBSTACLES, 135, 145, 175, 190)),
+    ('right_up_far', (OBSTACLES, 125, 135, 175, 190)),
+    ('center_close', (OBSTACLES, 140, 150, 150, 170)),
+    ('center_far', (OBSTACLES, 120, 140, 150, 170)),
+    ('center_left', (OBSTACLES, 140, 150, 130, 160)),
+    ('center_right', (OBSTACLES, 140, 150, 160, 190)),
+]
+
+
+class WindowFeatures:
+    """
+    Counts of the set pixels of vision_image in rectangular windows.
+    compute() builds the summed area table of each channel a window uses once per frame, over the bounding
+    box of that channel's windows only. After that every window is four lookups, and all the windows of
+    a channel are looked up together. New windows are registered once and cost their four lookups per frame
+    (and a larger table if they reach outside the current bounding box).
+    """
+
+    def __init__(self, windows=None):
+        self.names = []  # type: list
+        # name -> (channel, top, bottom, left, right)
+        self.windows = {}  # type: dict
+        # per channel: (channel, crop rows, crop cols, window indices, flat table indices of the 4 corners)
+        self.groups = []  # type: list
+        for name, window in (DEFAULT_WINDOWS if windows is None else windows):
+            self.register(name, *window)
+
+    def register(self, name, channel, top, bottom, left, right):
+        """
+        Add (or move) a window: rows top:bottom, columns left:right of a channel
+        :return:
+        """
+        if name not in self.windows:
+            self.names.append(name)
+        self.windows[name] = channel, top, bottom, left, right
+        self.groups = []
+        channels = np.array([self.windows[name][0] for name in self.names])
+        boxes = np.array([self.windows[name][1:] for name in self.names], dtype=np.intp)
+        for channel in np.unique(channels):
+            indices = np.flatnonzero(channels == channel)
+            top, bottom, left, right = boxes[indices].T
+            crop_rows = slice(top.min(), bottom.max())
+            crop_cols = slice(left.min(), right.max())
+            # window corners in the (crop rows + 1, crop cols + 1) table of the crop, looked up with one take
+            width = crop_cols.stop - crop_cols.start + 1
+            top, bottom = (top - crop_rows.start) * width, (bottom - crop_rows.start) * width
+            left, right = left - crop_cols.start, right - crop_cols.start
+            corners = np.stack([bottom + right, top + right, bottom + left, top + left])
+            self.groups.append((channel, crop_rows, crop_cols, indices, corners))
+
+    def compute(self, vision_image):
+        """
+        :param vision_image: (rows, cols, 3) perception image, any pixel > 0 counts
+        :return: {window name: set pixels}
+        """
+        counts = np.zeros(len(self.names), dtype=np.int64)
+        for channel, crop_rows, crop_cols, indices, corners in self.groups:
+            mask = (vision_image[crop_rows, crop_cols, channel] > 0).view(np.uint8)
+            bottom_right, top_right, bottom_left, top_left = cv2.integral(mask).take(corners)
+            counts[indices] = bottom_right - top_right - bottom_left + top_left
+        return dict(zip(self.names, counts.tolist()))
+
+
+def navigation_counts(nav_angles, limit=0.1):
+    """
+    Number of terrain pixels to the left, in the center and to the right of the rover
+    :param nav_angles: terrain angles in radians
+    :param limit: half width of the center in radians
+    :return: left, center, right
+    """
+    left = int(np.count_nonzero(nav_angles > limit))
+    right = int(np.count_nonzero(nav_angles < -limit))
+    return left, len(nav_angles) - left - right, right
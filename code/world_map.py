@@ -0,0 +1,421 @@
+import numpy as np
+
+_NO_CELLS = np.zeros(0, dtype=np.intp)
+# accumulate counts with a bincount over the span of the cells up to this many bins per point
+# (about twice as fast as sorting them), with np.unique above
+SPAN_PER_POINT = 16
+
+
+def accumulate(worldmap, rows, cols, channel, stats=None):
+    """
+    Scatter-add one hit per (row, col) pair into a channel of the worldmap.
+    Unlike worldmap[rows, cols, channel] += 1, duplicated cells get all of their hits.
+    The cell indices are flattened and counted with np.bincount over the range they span when that range
+    is at most SPAN_PER_POINT bins per point (a frame's cells are close together), otherwise with a sort
+    (np.unique). Either way the cost and the memory follow the number of points, not the size of the map.
+    :param worldmap: (rows, cols, channels) accumulator
+    :param rows: world y coordinates (array, scalar or None)
+    :param cols: world x coordinates (array, scalar or None)
+    :param channel: the channel to update
+    :param stats: MapStatistics to keep up to date with the update, or a tuple of such listeners
+                  (anything with the same update method, e.g. NavigationMap). They get the hits the cells
+                  actually gained, which is less than the hits when a compact (uint16) worldmap saturates
+    :return: the flat (row * width + col) indices of the cells that were updated
+    """
+    if rows is None or cols is None:
+        return _NO_CELLS
+    rows = np.atleast_1d(rows)
+    cols = np.atleast_1d(cols)
+    if rows.size == 0:
+        return _NO_CELLS
+
+    width = worldmap.shape[1]
+    cells = rows.astype(np.intp) * width + cols
+    first_cell = cells.min()
+    if cells.max() - first_cell < SPAN_PER_POINT * cells.size:
+        counts = np.bincount(cells - first_cell)
+        hits = np.flatnonzero(counts)
+        touched = hits + first_cell
+        counts = counts[hits]
+    else:
+        # far apart cells (e.g. a batch over a large map): the span could be gigabytes of bins
+        touched, counts = np.unique(cells, return_counts=True)
+    if isinstance(worldmap, TiledWorldMap):
+        counts = worldmap.scatter(touched, counts, channel)
+    else:
+        # every touched cell appears once now, so the fancy index update is safe
+        rows, cols = touched // width, touched % width
+        values = worldmap[rows, cols, channel]
+        totals = add_counts(values, counts, worldmap.dtype)
+        worldmap[rows, cols, channel] = totals
+        counts = added_counts(values, totals, counts, worldmap.dtype)
+    if isinstance(stats, tuple):
+        for listener in stats:
+            listener.update(channel, touched, counts)
+    elif stats is not None:
+        stats.update(channel, touched, counts)
+    return touched
+
+
+def add_counts(values, counts, dtype):
+    """
+    values + counts in dtype, saturating at the largest value of integer types instead of wrapping around
+    :param values: current cell values
+    :param counts: counts to add
+    :param dtype: the accumulator type
+    :return: 
+    """
+    total = values + counts
+    if dtype.kind in 'ui':
+        total = np.minimum(total, np.iinfo(dtype).max)
+    return total.astype(dtype)
+
+
+def added_counts(values, totals, counts, dtype):
+    """
+    What add_counts really added: counts, unless some cells saturated
+    :param values: cell values before
+    :param totals: add_counts(values, counts, dtype)
+    :param counts: counts that were added
+    :param dtype: the accumulator type
+    :return: 
+    """
+    if dtype.kind in 'ui' and np.any(totals == np.iinfo(dtype).max):
+        return totals.astype(np.int64) - values
+    return counts
+
+
+class TiledWorldMap:
+    """
+    A worldmap that only allocates square tiles where something was accumulated.
+    Memory grows with the explored area instead of the world area, so the world can be larger
+    and the resolution finer than the 200x200 dense map. Use display_view for the dense [y, x, channel] map.
+    """
+
+    def __init__(self, world_size=200, resolution=1, tile_meters=16, channels=3, dtype=np.int32):
+        # side of a tile in map cells
+        self.tile_size = tile_meters * resolution  # type: int
+        self.resolution = resolution  # type: int
+        self.world_size = world_size  # type: int
+        self.shape = (world_size * resolution, world_size * resolution, channels)  # type: tuple
+        self.dtype = np.dtype(dtype)
+        # (tile_row, tile_col) -> (tile_size, tile_size, channels) array
+        self.tiles = {}  # type: dict
+
+    @property
+    def nbytes(self):
+        return sum(tile.nbytes for tile in self.tiles.values())
+
+    def tile(self, tile_row, tile_col):
+        """
+        The tile at (tile_row, tile_col), allocated on first access
+        :return: 
+        """
+        key = (tile_row, tile_col)
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = np.zeros((self.tile_size, self.tile_size, self.shape[2]), dtype=self.dtype)
+            self.tiles[key] = tile
+        return tile
+
+    def scatter(self, cells, counts, channel):
+        """
+        Add counts to the cells of a channel
+        :param cells: unique flat (row * width + col) cell indices
+        :param counts: the count to add to each cell
+        :param channel: the channel to update
+        :return: the counts the cells gained (less than counts where they saturated)
+        """
+        added = counts
+        rows, cols = np.divmod(cells, self.shape[1])
+        tile_rows, in_rows = np.divmod(rows, self.tile_size)
+        tile_cols, in_cols = np.divmod(cols, self.tile_size)
+        tile_ids = tile_rows * self.shape[1] + tile_cols
+        for tile_id in np.unique(tile_ids):
+            selected = tile_ids == tile_id
+            tile = self.tile(*divmod(int(tile_id), self.shape[1]))
+            rows, cols, tile_counts = in_rows[selected], in_cols[selected], counts[selected]
+            values = tile[rows, cols, channel]
+            totals = add_counts(values, tile_counts, self.dtype)
+            tile[rows, cols, channel] = totals
+            tile_added = added_counts(values, totals, tile_counts, self.dtype)
+            if tile_added is not tile_counts:
+                # some cells of this tile saturated
+                if added is counts:
+                    added = counts.astype(np.int64)
+                added[selected] = tile_added
+        return added
+
+    def view(self):
+        """
+        Dense (world_size, world_size, channels) map with the cells of every meter summed up
+        :return: 
+        """
+        size = self.world_size
+        tile_meters = self.tile_size // self.resolution
+        dense = np.zeros((size, size, self.shape[2]), dtype=self.dtype)
+        for (tile_row, tile_col), tile in self.tiles.items():
+            row, col = tile_row * tile_meters, tile_col * tile_meters
+            block = downsample(tile, self.resolution)
+            # the last row/column of tiles can go past the world edge
+            block = block[:size - row, :size - col]
+            dense[row:row + block.shape[0], col:col + block.shape[1]] = block
+        return dense
+
+
+def downsample(worldmap, resolution):
+    """
+    Sum every resolution x resolution block of cells into one cell
+    :param worldmap: dense (rows, cols, channels) map
+    :param resolution: cells per meter
+    :return: 
+    """
+    if resolution == 1:
+        return worldmap
+    rows, cols, channels = worldmap.shape
+    blocks = worldmap.reshape(rows // resolution, resolution, cols // resolution, resolution, channels)
+    return add_counts(0, blocks.sum(axis=(1, 3)), worldmap.dtype)
+
+
+def create_worldmap(world_size=200, resolution=1, tiled=False, dtype=np.int32):
+    """
+    Allocate a worldmap accumulator
+    :param world_size: side of the world in meters
+    :param resolution: map cells per meter
+    :param tiled: allocate tiles lazily instead of one dense array
+    :param dtype: accumulator type
+    :return: 
+    """
+    if tiled:
+        return TiledWorldMap(world_size, resolution, dtype=dtype)
+    return np.zeros((world_size * resolution, world_size * resolution, 3), dtype=dtype)
+
+
+def display_view(worldmap, resolution=1):
+    """
+    The dense one cell per meter [y, x, channel] view of a worldmap, as used for display and navigation
+    :param worldmap: dense array or TiledWorldMap
+    :param resolution: cells per meter of a dense worldmap
+    :return: 
+    """
+    if isinstance(worldmap, TiledWorldMap):
+        return worldmap.view()
+    return downsample(worldmap, resolution)
+
+
+class MapStatistics:
+    """
+    Counters of the one cell per meter map, updated only with the cells each accumulation touches.
+    Cells never lose hits, so a cell is counted once, the first time it gets any.
+    Replaces the full map passes create_output_images used to run on every frame.
+    The hits are those the worldmap cells gained (accumulate stops counting the ones a compact map saturates),
+    but a display cell summing resolution^2 worldmap cells can still saturate in map_view when they do not.
+    """
+
+    def __init__(self, world_size=200, resolution=1):
+        self.world_size = world_size  # type: int
+        self.resolution = resolution  # type: int
+        # [channel, y, x] cells of the display map that have hits
+        self.seen = np.zeros((3, world_size, world_size), dtype=np.bool_)  # type: np.ndarray
+        # number of seen cells and total hits per channel
+        self.cells = [0, 0, 0]  # type: list
+        self.hits = [0, 0, 0]  # type: list
+        # ground truth navigable cells, the number of them and how many seen terrain cells are on them
+        self.ground_truth = None  # type: np.ndarray
+        self.tot_map_pix = 0  # type: int
+        self.good_nav_pix = 0  # type: int
+
+    def set_ground_truth(self, ground_truth):
+        """
+        :param ground_truth: boolean (world_size, world_size) mask of the navigable terrain
+        :return: 
+        """
+        self.ground_truth = np.ascontiguousarray(ground_truth, dtype=np.bool_)
+        self.tot_map_pix = int(np.count_nonzero(self.ground_truth))
+        self.good_nav_pix = int(np.count_nonzero(self.seen[2] & self.ground_truth))
+
+    def rebuild(self, worldmap):
+        """
+        Recompute every counter from a whole one cell per meter map, e.g. one that was built elsewhere
+        :param worldmap: (world_size, world_size, 3) display map
+        :return: 
+        """
+        for channel in range(3):
+            self.seen[channel] = worldmap[:, :, channel] > 0
+            self.cells[channel] = int(np.count_nonzero(self.seen[channel]))
+            self.hits[channel] = int(worldmap[:, :, channel].sum(dtype=np.int64))
+        if self.ground_truth is not None:
+            self.good_nav_pix = int(np.count_nonzero(self.seen[2] & self.ground_truth))
+
+    def update(self, channel, cells, counts):
+        """
+        Account for the hits added to a channel of the worldmap
+        :param channel: the updated channel
+        :param cells: unique flat worldmap cells that got hits
+        :param counts: hits per cell
+        :return: flat indices of the display map cells that got their first hit
+        """
+        self.hits[channel] += int(counts.sum())
+        rows, cols = np.divmod(cells, self.world_size * self.resolution)
+        display_cells = (rows // self.resolution) * self.world_size + cols // self.resolution
+        seen = self.seen[channel].reshape(-1)
+        new_cells = np.unique(display_cells[~seen[display_cells]])
+        seen[new_cells] = True
+        self.cells[channel] += new_cells.size
+        if channel == 2 and self.ground_truth is not None:
+            self.good_nav_pix += int(np.count_nonzero(self.ground_truth.reshape(-1)[new_cells]))
+        return new_cells
+
+    def mean(self, channel):
+        """
+        Mean hits of the cells of a channel that have any
+        :return: 
+        """
+        return self.hits[channel] / self.cells[channel] if self.cells[channel] > 0 else 0
+
+
+class ChangeFeed:
+    """
+    The navigation map cells that changed since its consumer last asked (see NavigationMap.subscribe)
+    """
+
+    def __init__(self):
+        self.pending = []  # type: list
+
+    def take(self):
+        """
+        :return: unique flat (row * world_size + col) indices of the changed cells, and forget them
+        """
+        if len(self.pending) == 0:
+            return _NO_CELLS
+        changed = np.unique(np.concatenate(self.pending))
+        self.pending = []
+        return changed
+
+
+# A square meter of ground is scale x scale pixels of the warped image (PerceptionContext.scale), one hit each.
+# The terrain or obstacle channel of a display cell gets about this fraction of them from a frame that sees it
+# (cells at the edge of the view or split between terrain and obstacles get less). Measured as the median,
+# over the cells and frames of a recorded run, of the hits accumulate passes its listeners for channels 0 and 2,
+# summed per display cell and divided by scale ** 2. Re-measure it that way if the classifier or the warp change
+SEEN_FRACTION = 0.64
+
+
+def hits_per_frame(scale):
+    """
+    The hits one frame adds to a display cell it sees.
+    The pixels of a frame land on the same meters whatever the map resolution, so it only depends on the scale
+    :param scale: warped image pixels per meter (PerceptionContext.scale)
+    :return: 
+    """
+    return max(1, int(round(SEEN_FRACTION * scale * scale)))
+
+
+# for the default PerceptionContext (10 pixels per meter)
+HITS_PER_FRAME = hits_per_frame(10)
+
+
+class NavigationMap:
+    """
+    The navigation codes of the one cell per meter map (unknown, terrain, obstacle, visited), maintained
+    incrementally: accumulate (as a listener, like MapStatistics) and visit mark the cells they touch,
+    refresh reclassifies only those and tells the subscribers which codes changed.
+    A cell is terrain or obstacle once its hits are worth confirm_frames frames (hits_per_frame each),
+    so a single misclassified frame does not flip it.
+    """
+    UNKNOWN = -1
+    TERRAIN = 0
+    OBSTACLE = -2
+    VISITED = 1
+
+    def __init__(self, world_size=200, resolution=1, confirm_frames=10, dtype=np.int64,
+                 hits_per_frame=HITS_PER_FRAME):
+        """
+        :param world_size: side of the world in meters
+        :param resolution: worldmap cells per meter
+        :param confirm_frames: frames that must see a cell before it is terrain or obstacle
+        :param hits_per_frame: hits one frame adds to a cell it sees, see hits_per_frame()
+        :param dtype: type of the codes
+        """
+        self.world_size = world_size  # type: int
+        self.resolution = resolution  # type: int
+        # hits (summed over the worldmap cells of the display cell) a cell needs before it is terrain or obstacle
+        self.threshold = confirm_frames * hits_per_frame  # type: int
+        self.codes = np.full((world_size, world_size), self.UNKNOWN, dtype=dtype)  # type: np.ndarray
+        # obstacle and terrain hits of every display cell
+        self.obstacles = np.zeros(world_size * world_size, dtype=np.int64)  # type: np.ndarray
+        self.terrain = np.zeros(world_size * world_size, dtype=np.int64)  # type: np.ndarray
+        self.visited = np.zeros(world_size * world_size, dtype=np.bool_)  # type: np.ndarray
+        # flat display cells touched since the last refresh
+        self.dirty = []  # type: list
+        self.feeds = []  # type: list
+
+    def subscribe(self):
+        """
+        :return: a ChangeFeed collecting the cells every refresh changes
+        """
+        feed = ChangeFeed()
+        self.feeds.append(feed)
+        return feed
+
+    def update(self, channel, cells, counts):
+        """
+        Account for the hits accumulate added to a channel of the worldmap (rocks do not change the codes)
+        :param channel: the updated channel
+        :param cells: unique flat worldmap cells that got hits
+        :param counts: hits per cell
+        :return: 
+        """
+        if channel == 1:
+            return
+        rows, cols = np.divmod(cells, self.world_size * self.resolution)
+        display_cells = (rows // self.resolution) * self.world_size + cols // self.resolution
+        # several worldmap cells share a display cell when resolution > 1
+        np.add.at(self.obstacles if channel == 0 else self.terrain, display_cells, counts)
+        self.dirty.append(display_cells)
+
+    def visit(self, row, col):
+        """
+        Mark a display cell as visited
+        :return: 
+        """
+        cell = row * self.world_size + col
+        if not self.visited[cell]:
+            self.visited[cell] = True
+            self.dirty.append(np.array([cell], dtype=np.intp))
+
+    def refresh(self):
+        """
+        Reclassify the cells touched since the last refresh
+        :return: flat indices of the cells whose code changed
+        """
+        if len(self.dirty) == 0:
+            return _NO_CELLS
+        cells = np.unique(np.concatenate(self.dirty))
+        self.dirty = []
+        terrain, obstacles = self.terrain[cells], self.obstacles[cells]
+        codes = np.full(cells.shape, self.UNKNOWN, dtype=self.codes.dtype)
+        codes[(terrain > obstacles) & (terrain > self.threshold)] = self.TERRAIN
+        codes[(obstacles > terrain) & (obstacles > self.threshold)] = self.OBSTACLE
+        codes[self.visited[cells]] = self.VISITED
+        flat_codes = self.codes.reshape(-1)
+        different = flat_codes[cells] != codes
+        changed = cells[different]
+        if changed.size > 0:
+            flat_codes[changed] = codes[different]
+            for feed in self.feeds:
+                feed.pending.append(changed)
+        return changed
+
+    def rebuild(self, worldmap, visited_map):
+        """
+        Recompute every code from a whole one cell per meter map
+        :param worldmap: (world_size, world_size, 3) display map
+        :param visited_map: (world_size, world_size) visited cells
+        :return: flat indices of the cells whose code changed
+        """
+        self.obstacles[:] = worldmap[:, :, 0].reshape(-1)
+        self.terrain[:] = worldmap[:, :, 2].reshape(-1)
+        self.visited[:] = visited_map.reshape(-1) != 0
+        self.dirty = [np.arange(self.codes.size)]
+        return self.refresh()